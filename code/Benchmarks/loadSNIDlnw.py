@@ -0,0 +1,112 @@
+import sys
+sys.path.append('../')
+import SNIDsn
+import numpy as np
+import timeit
+
+
+# Benchmark of SNIDsn.loadSNIDlnw against the previous loader, which read every
+# template three times (readlines, then np.loadtxt for the wavelengths, then
+# np.loadtxt again for the structured flux columns).
+# Usage: python loadSNIDlnw.py [template directory] [template list]
+
+def loadSNIDlnw_loadtxt(lnwfile):
+    """
+    Previous .lnw loader, kept here as the reference for the benchmark.
+
+    Parameters
+    ----------
+    lnwfile : string
+
+    Returns
+    -------
+    snobj : SNIDsn object
+
+    """
+    snobj = SNIDsn.SNIDsn()
+    with open(lnwfile) as lnw:
+        lines = lnw.readlines()
+        lnw.close()
+    header_line = lines[0].strip()
+    header_items = header_line.split()
+    header = dict()
+    header['Nspec'] = int(header_items[0])
+    header['Nbins'] = int(header_items[1])
+    header['WvlStart'] = float(header_items[2])
+    header['WvlEnd'] = float(header_items[3])
+    header['SplineKnots'] = int(header_items[4])
+    header['SN'] = header_items[5]
+    header['dm15'] = float(header_items[6])
+    header['TypeStr'] = header_items[7]
+    header['TypeInt'] = int(header_items[8])
+    header['SubTypeInt'] = int(header_items[9])
+    snobj.header = header
+
+    tp, subtp = SNIDsn.getType(header['TypeInt'], header['SubTypeInt'])
+    snobj.type = tp
+    snobj.subtype = subtp
+
+    phase_line_ind = len(lines) - snobj.header['Nbins'] - 1
+    phase_items = lines[phase_line_ind].strip().split()
+    snobj.phaseType = int(phase_items[0])
+    snobj.phases = np.array([float(ph) for ph in phase_items[1:]])
+
+    snobj.wavelengths = np.loadtxt(lnwfile, skiprows=phase_line_ind + 1, usecols=0)
+    lnwdtype = []
+    colnames = []
+    for ph in snobj.phases:
+        colname = 'Ph'+str(ph)
+        if colname in colnames:
+            colname = colname + 'v1'
+        count = 2
+        while(colname in colnames):
+            colname = colname[0:-2] + 'v'+str(count)
+            count = count + 1
+        colnames.append(colname)
+        lnwdtype.append((colname, 'f4'))
+    snobj.data = np.loadtxt(lnwfile, dtype=lnwdtype, skiprows=phase_line_ind + 1,
+                            usecols=range(1,len(snobj.phases) + 1))
+
+    continuumcols = len(lines[1].strip().split())
+    continuum = np.ndarray((phase_line_ind - 1,continuumcols))
+    for ind in np.arange(1,phase_line_ind - 0):
+        cont_line = lines[ind].strip().split()
+        continuum[ind - 1] = np.array([float(x) for x in cont_line])
+    snobj.continuum = continuum
+    return snobj
+
+def loadSNIDlnw_parser(lnwfile):
+    snobj = SNIDsn.SNIDsn()
+    snobj.loadSNIDlnw(lnwfile)
+    return snobj
+
+def checkParity(new, old):
+    assert new.header == old.header
+    assert new.type == old.type and new.subtype == old.subtype
+    assert new.phaseType == old.phaseType
+    assert np.array_equal(new.phases, old.phases)
+    assert np.array_equal(new.wavelengths, old.wavelengths)
+    assert new.data.dtype == old.data.dtype
+    assert new.data.tobytes() == old.data.tobytes()
+    assert np.array_equal(new.continuum, old.continuum)
+    return
+
+
+pathdir = '../Tutorial_Data/'
+snlist = '../Tutorial_Data/snlist.txt'
+if len(sys.argv) > 1:
+    pathdir = sys.argv[1]
+if len(sys.argv) > 2:
+    snlist = sys.argv[2]
+
+with open(snlist) as f:
+    files = [pathdir + line.strip() for line in f if line.strip() != '']
+
+for lnwfile in files:
+    checkParity(loadSNIDlnw_parser(lnwfile), loadSNIDlnw_loadtxt(lnwfile))
+print('parity ok for %i templates'%(len(files)))
+
+nrepeat = 5
+for name, loader in [('loadtxt', loadSNIDlnw_loadtxt), ('single pass', loadSNIDlnw_parser)]:
+    t = min(timeit.repeat(lambda: [loader(lnwfile) for lnwfile in files], number=1, repeat=nrepeat))
+    print('%12s loader: %.2f ms per template (%.3f s for %i templates)'%(name, 1000*t/len(files), t, len(files)))
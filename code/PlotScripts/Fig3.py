@@ -18,10 +18,10 @@ import pandas
 
 # datasetX contains the SNID spectra for the phase range X +/- 5 days, where each SNe has only 1 spectrum in this phase range.  The spectrum with phase closest to X is chosen. All of the preprocessing has been applied (wavelength cut, smoothing, phase type, etc)
 
-dataset0 = snid.loadPickle('../../Data/DataProducts/dataset0.pickle')
-dataset5 = snid.loadPickle('../../Data/DataProducts/dataset5.pickle')
-dataset10 = snid.loadPickle('../../Data/DataProducts/dataset10.pickle')
-dataset15 = snid.loadPickle('../../Data/DataProducts/dataset15.pickle')
+dataset0 = snid.load('../../Data/DataProducts/dataset0.npz')
+dataset5 = snid.load('../../Data/DataProducts/dataset5.npz')
+dataset10 = snid.load('../../Data/DataProducts/dataset10.npz')
+dataset15 = snid.load('../../Data/DataProducts/dataset15.npz')
 
 
 # ### Run PCA
@@ -0,0 +1,328 @@
+import SNIDsn as snid
+import SNIDdataset as snidset
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import time
+
+CACHE_VERSION = 1
+
+
+def fileHash(path):
+    """
+    Returns the sha256 hex digest of the contents of a file.
+
+    Parameters
+    ----------
+    path : string
+
+    Returns
+    -------
+    digest : string
+
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def stageKey(parentKey, stage, params):
+    """
+    Returns the cache key of a preprocessing stage applied to the result
+    identified by parentKey. Keys are chained, so a key changes whenever the
+    source template or the parameters of the stage or of any earlier stage
+    change.
+
+    Parameters
+    ----------
+    parentKey : string
+        key of the input of the stage, e.g. a fileHash for the first stage.
+    stage : string
+        stage name.
+    params : list
+        JSON serializable stage parameters.
+
+    Returns
+    -------
+    key : string
+
+    """
+    desc = json.dumps([CACHE_VERSION, parentKey, stage, params], default=snidset.jsonDefault)
+    return hashlib.sha256(desc.encode('utf-8')).hexdigest()
+
+def templateType(lnwfile):
+    """
+    Reads the SN type of a SNID template from its header line only.
+
+    Parameters
+    ----------
+    lnwfile : string
+
+    Returns
+    -------
+    sntype : string
+
+    """
+    with open(lnwfile) as lnw:
+        header_items = lnw.readline().split()
+    sntype, snsubtype = snid.getType(int(header_items[8]), int(header_items[9]))
+    return sntype
+
+def smoothVelcut(sntype, velcut, velcutIcBL):
+    """
+    Returns the velocity cut SNIDdataset.smoothSpectra uses for a SN type,
+    or None if spectra of that type are not smoothed.
+
+    Parameters
+    ----------
+    sntype : string
+    velcut : float
+    velcutIcBL : float
+
+    Returns
+    -------
+    cut : float
+
+    """
+    if sntype == 'IcBL':
+        return velcutIcBL
+    if sntype in ('IIb', 'Ib', 'Ic'):
+        return velcut
+    return None
+
+
+class SNIDcache:
+    """
+    Content-addressed on-disk cache of preprocessed SNIDsn objects. Each entry
+    is the result of one preprocessing stage for one SN, stored under the
+    chained key of the stage (see stageKey) as a single SN file in the
+    SNIDdataset.save format. Entries are never invalidated in place: a new
+    template or new parameters produce new keys, and old entries can be
+    removed with clear.
+    """
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        return
+
+    def path(self, key):
+        """
+        Returns the path of the cache entry for key.
+        """
+        return os.path.join(self.cachedir, key[:2], key + '.npz')
+
+    def deletedPath(self, key):
+        """
+        Returns the path of the marker recording that the stage removed the SN.
+        """
+        return os.path.join(self.cachedir, key[:2], key + '.deleted')
+
+    def has(self, key):
+        """
+        Returns True if the cache has an entry for key.
+        """
+        return os.path.exists(self.path(key)) or os.path.exists(self.deletedPath(key))
+
+    def get(self, key):
+        """
+        Returns the cached SNIDsn object for key, or None if the stage
+        removed the SN from the dataset. Raises KeyError if there is no entry.
+
+        Parameters
+        ----------
+        key : string
+
+        Returns
+        -------
+        snobj : SNIDsn object
+
+        """
+        if os.path.exists(self.deletedPath(key)):
+            return None
+        if not os.path.exists(self.path(key)):
+            raise KeyError(key)
+        dataset = snidset.load(self.path(key))
+        return dataset[list(dataset.keys())[0]]
+
+    def put(self, key, snname, snobj):
+        """
+        Stores the result of a stage for one SN. snobj=None records that the
+        stage removed the SN from the dataset.
+
+        Parameters
+        ----------
+        key : string
+        snname : string
+        snobj : SNIDsn object
+
+        Returns
+        -------
+
+        """
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if snobj is None:
+            open(self.deletedPath(key), 'w').close()
+            return
+        # write to a temporary file first so an interrupted run never
+        # leaves a truncated entry behind.
+        tmppath = path[:-len('.npz')] + '.%i.tmp.npz'%(os.getpid())
+        snidset.save(tmppath, OrderedDict([(snname, snobj)]))
+        os.replace(tmppath, path)
+        return
+
+    def clear(self, keep=None):
+        """
+        Removes all cache entries, except the ones whose keys are in keep.
+
+        Parameters
+        ----------
+        keep : iterable
+            keys to keep.
+
+        Returns
+        -------
+        nremoved : int
+
+        """
+        keep = set() if keep is None else set(keep)
+        nremoved = 0
+        for root, dirs, files in os.walk(self.cachedir):
+            for filename in files:
+                key = filename.split('.')[0]
+                if key not in keep:
+                    os.remove(os.path.join(root, filename))
+                    nremoved = nremoved + 1
+        return nremoved
+
+
+def buildDataset(cachedir, pathdir, snlist, minwvl, maxwvl, maxgapsize, velcut, velcutIcBL,\
+                 phaseRangeList, uniquePhaseFlag, nproc=None, columnar=True, verbose=True):
+    """
+    Runs the preprocessing pipeline
+    loadDataset -> snidsetNAN -> interpGaps -> datasetWavelengthRange -> smoothSpectra -> filterPhases
+    through a SNIDcache. The result of every stage is cached per SN under a
+    key chained from the .lnw file hash and the parameters of that stage and
+    all earlier stages. Only the stage parameters a SN actually depends on
+    enter its key, e.g. changing velcutIcBL only recomputes the smoothing of
+    IcBL SNe. For each SN the pipeline resumes from its latest cached stage,
+    and the SNe that need a stage are processed together with the regular
+    SNIDdataset functions.
+
+    Parameters
+    ----------
+    cachedir : string
+        cache directory.
+    pathdir : string
+        Path to SNID template directory
+    snlist : string or list
+        Path to file with list of SNID templates, or the list itself.
+    minwvl : float
+        minimum wavelength
+    maxwvl : float
+        maximum wavelength
+    maxgapsize : float
+        maximum gap size tolerable for interpolation (angstroms)
+    velcut : float
+        velocity cut for SN features of non broad line type spectra.
+    velcutIcBL : float
+        velocity cut for SN features of broad line Ic spectra.
+    phaseRangeList : list
+        list of (minPhase, maxPhase) tuples
+    uniquePhaseFlag : Boolean
+        see SNIDdataset.filterPhases
+    nproc : int
+        Number of worker processes for loading templates.
+    columnar : Boolean
+        Returns spectra stored in SpecTables if True, otherwise in structured arrays.
+    verbose : Boolean
+        Prints how many SNe were reused or recomputed per stage if True.
+
+    Returns
+    -------
+    dataset : SNIDdataset object
+
+    """
+    t0 = time.time()
+    cache = SNIDcache(cachedir)
+    if isinstance(snlist, str):
+        with open(snlist) as f:
+            filenames = [line.strip() for line in f if line.strip() != '']
+    else:
+        filenames = [filename.strip() for filename in snlist if filename.strip() != '']
+    snnames = [filename.split('.')[0] for filename in filenames]
+    phaseRanges = [list(phaseRange) for phaseRange in phaseRangeList]
+
+    stages = ['loadDataset', 'snidsetNAN', 'interpGaps', 'datasetWavelengthRange', 'smoothSpectra', 'filterPhases']
+    keys = OrderedDict()
+    for filename, snname in zip(filenames, snnames):
+        lnwfile = pathdir + filename
+        cut = smoothVelcut(templateType(lnwfile), velcut, velcutIcBL)
+        params = [[], [], [minwvl, maxwvl, maxgapsize], [minwvl, maxwvl], [cut], [phaseRanges, uniquePhaseFlag]]
+        key = fileHash(lnwfile)
+        snkeys = []
+        for stage, stageParams in zip(stages, params):
+            key = stageKey(key, stage, stageParams)
+            snkeys.append(key)
+        keys[snname] = snkeys
+
+    # resume every SN from its latest cached stage. SNe removed by a stage
+    # skip the remaining stages.
+    last = len(stages) - 1
+    reached = OrderedDict()
+    objs = OrderedDict()
+    for snname in snnames:
+        reached[snname] = -1
+        objs[snname] = None
+        for i in range(last, -1, -1):
+            if cache.has(keys[snname][i]):
+                objs[snname] = cache.get(keys[snname][i])
+                reached[snname] = i if objs[snname] is not None else last
+                break
+
+    for i, stage in enumerate(stages):
+        todo = [snname for snname in snnames if reached[snname] == i - 1]
+        if verbose:
+            print('%s: %i cached, %i to compute'%(stage, sum(1 for sn in snnames if reached[sn] >= i), len(todo)))
+        if len(todo) == 0:
+            continue
+        if stage == 'loadDataset':
+            todoFiles = [filename for filename, snname in zip(filenames, snnames) if snname in todo]
+            subset, failed = snidset.loadDataset(pathdir, todoFiles, nproc=nproc, verbose=False, returnFailed=True)
+            snidset.toColumnar(subset)
+            for filename, error in failed:
+                # failed templates are reported but not cached.
+                print('failed: %s (%s)'%(filename, error))
+                reached[filename.split('.')[0]] = last
+            todo = [snname for snname in todo if snname in subset]
+        else:
+            subset = OrderedDict((snname, objs[snname]) for snname in todo)
+            if stage == 'snidsetNAN':
+                snidset.snidsetNAN(subset)
+            elif stage == 'interpGaps':
+                snidset.interpGaps(subset, minwvl, maxwvl, maxgapsize)
+            elif stage == 'datasetWavelengthRange':
+                snidset.datasetWavelengthRange(subset, minwvl, maxwvl)
+            elif stage == 'smoothSpectra':
+                snidset.smoothSpectra(subset, velcut, velcutIcBL)
+            elif stage == 'filterPhases':
+                snidset.filterPhases(subset, phaseRangeList, uniquePhaseFlag)
+        for snname in todo:
+            objs[snname] = subset.get(snname)
+            cache.put(keys[snname][i], snname, objs[snname])
+            reached[snname] = i if objs[snname] is not None else last
+
+    dataset = OrderedDict()
+    for snname in snnames:
+        if objs[snname] is not None:
+            dataset[snname] = objs[snname]
+    if not columnar:
+        snidset.toStructured(dataset)
+    if verbose:
+        print('built dataset of %i SNe in %.2f s'%(len(dataset), time.time() - t0))
+    return dataset
@@ -4,6 +4,13 @@ import SNIDsn as snid
 import matplotlib.pyplot as plt
 from collections import OrderedDict
 import pickle
+import multiprocessing
+import time
+import json
+import struct
+import zipfile
+
+DATASET_FORMAT_VERSION = 1
 
 def savePickle(path, dataset, protocol=2):
     """
@@ -43,35 +50,384 @@ def loadPickle(path):
     d = pickle.load(f)
     return d
 
-def loadDataset(pathdir, snlist):
+def jsonDefault(obj):
+    """
+    Converts numpy scalars for json.dumps.
+    """
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("%s is not JSON serializable"%(type(obj)))
+
+def save(path, dataset):
     """
-    Creates a SNIDdataset object from a list of SNID templates.
+    Saves a SNIDdataset object in the versioned binary dataset format, an
+    uncompressed .npz file of aligned arrays. Spectra are stored as one
+    (nspec, nwvl) float32 flux block together with the phases, phase keys
+    and the index of the SN each spectrum belongs to. Per SN the names,
+    types, subtypes, phase types, wavelength arrays, headers, continua,
+    smoothing info and smoothing uncertainties (and pcaCoeffs if every SN
+    has them) are stored. Other attributes, e.g. data_unflat, are not
+    saved. All SNe must have the same number of wavelength bins, e.g. after
+    datasetWavelengthRange. No pickled objects are written, so the file can
+    be read with allow_pickle=False.
+
+    Parameters
+    ----------
+    path : string
+        output path. np.savez appends .npz if missing.
+    dataset : SNIDdataset object
+
+    Returns
+    -------
+
+    """
+    snnames = list(dataset.keys())
+    snobjs = [dataset[snname] for snname in snnames]
+    nwvl = set(len(snobj.wavelengths) for snobj in snobjs)
+    if len(nwvl) > 1:
+        raise ValueError("all SNe must have the same number of wavelength bins, found %s"%(sorted(nwvl)))
+    nwvl = nwvl.pop() if len(nwvl) == 1 else 0
+
+    grids = OrderedDict()
+    gridInd = []
+    for snobj in snobjs:
+        key = snobj.wavelengths.tobytes()
+        if key not in grids:
+            grids[key] = (len(grids), snobj.wavelengths)
+        gridInd.append(grids[key][0])
+
+    flux, specSN, phases, phasekeys, uncertainty, hasUncertainty = [], [], [], [], [], []
+    for i, snobj in enumerate(snobjs):
+        colnames = snobj.getSNCols()
+        flux.append(snobj.specMatrix().T.astype('f4'))
+        specSN.extend([i]*len(colnames))
+        phases.extend(snobj.phases)
+        phasekeys.extend(colnames)
+        for col in colnames:
+            unc = snobj.smooth_uncertainty.get(col)
+            hasUncertainty.append(unc is not None)
+            if unc is None:
+                unc = np.full(nwvl, np.nan)
+            elif len(unc) != nwvl:
+                raise ValueError("smooth_uncertainty of %s %s does not match its wavelengths"%(snobj.header['SN'], col))
+            uncertainty.append(unc)
+
+    arrays = dict()
+    arrays['version'] = np.array(DATASET_FORMAT_VERSION)
+    arrays['snnames'] = np.array(snnames, dtype=str)
+    arrays['types'] = np.array([snobj.type for snobj in snobjs], dtype=str)
+    arrays['subtypes'] = np.array([snobj.subtype for snobj in snobjs], dtype=str)
+    arrays['phaseTypes'] = np.array([snobj.phaseType for snobj in snobjs], dtype=int)
+    arrays['headers'] = np.array([json.dumps(snobj.header, default=jsonDefault) for snobj in snobjs], dtype=str)
+    arrays['smoothinfo'] = np.array([json.dumps(snobj.smoothinfo, default=jsonDefault) for snobj in snobjs], dtype=str)
+    arrays['wavelengths'] = np.array([wvl for ind, wvl in grids.values()], dtype=np.float64).reshape(len(grids), nwvl)
+    arrays['gridInd'] = np.array(gridInd, dtype=int)
+    continua = [np.asarray(snobj.continuum, dtype=np.float64) for snobj in snobjs]
+    arrays['continuumShape'] = np.array([cont.shape for cont in continua], dtype=int).reshape(len(snobjs), 2)
+    arrays['continuum'] = np.concatenate([cont.ravel() for cont in continua]) if len(continua) > 0 else np.zeros(0)
+    arrays['flux'] = np.vstack(flux) if len(flux) > 0 else np.zeros((0, nwvl), dtype='f4')
+    arrays['specSN'] = np.array(specSN, dtype=int)
+    arrays['phases'] = np.array(phases, dtype=np.float64)
+    arrays['phasekeys'] = np.array(phasekeys, dtype=str)
+    arrays['uncertainty'] = np.array(uncertainty, dtype=np.float64).reshape(len(phasekeys), nwvl)
+    arrays['hasUncertainty'] = np.array(hasUncertainty, dtype=bool)
+    if len(snobjs) > 0 and all(hasattr(snobj, 'pcaCoeffs') for snobj in snobjs):
+        pcaCoeffs = [np.asarray(snobj.pcaCoeffs) for snobj in snobjs]
+        if len(set(coeffs.shape for coeffs in pcaCoeffs)) == 1:
+            arrays['pcaCoeffs'] = np.array(pcaCoeffs)
+    np.savez(path, **arrays)
+    return
+
+def memmapNpzMember(path, name, mmap_mode='r'):
+    """
+    Memory-maps an array stored uncompressed in a .npz file.
+
+    Parameters
+    ----------
+    path : string
+        path to .npz file.
+    name : string
+        name of the array in the .npz file.
+    mmap_mode : string
+        numpy.memmap mode, 'r', 'r+' or 'c'.
+
+    Returns
+    -------
+    arr : np.memmap
+
+    """
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("%s in %s is compressed and cannot be memory-mapped"%(name, path))
+    with open(path, 'rb') as f:
+        f.seek(info.header_offset)
+        localHeader = f.read(30)
+        fnameLen, extraLen = struct.unpack('<HH', localHeader[26:30])
+        f.seek(info.header_offset + 30 + fnameLen + extraLen)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if np.prod(shape) == 0:
+        return np.zeros(shape, dtype=dtype)
+    order = 'F' if fortran else 'C'
+    return np.memmap(path, dtype=dtype, mode=mmap_mode, offset=offset, shape=shape, order=order)
+
+def continuumOffsets(arrays):
+    """
+    Returns the start offset of every SN's continuum in the flattened
+    continuum array of the binary dataset format.
+
+    Parameters
+    ----------
+    arrays : dict
+        arrays of a file written by SNIDdataset.save.
+
+    Returns
+    -------
+    contStart : np.array
+        (nsn + 1) offsets.
+
+    """
+    return np.concatenate(([0], np.cumsum(np.prod(arrays['continuumShape'], axis=1))))
+
+def snidsnFromArrays(arrays, i, specRows, flux, contStart, columnar=True):
+    """
+    Builds the SNIDsn object of the i-th SN from the arrays of the binary
+    dataset format.
+
+    Parameters
+    ----------
+    arrays : dict
+        arrays of a file written by SNIDdataset.save.
+    i : int
+        SN index.
+    specRows : np.array
+        indices of the spectra of the SN to include.
+    flux : np.array
+        (len(specRows), nwvl) flux rows of those spectra.
+    contStart : np.array
+        continuum offsets from continuumOffsets.
+    columnar : Boolean
+        Stores the spectra in a SpecTable if True, otherwise copies them
+        into a structured array.
+
+    Returns
+    -------
+    snobj : SNIDsn object
+
+    """
+    contShape = arrays['continuumShape']
+    snobj = snid.SNIDsn()
+    snobj.header = json.loads(str(arrays['headers'][i]))
+    snobj.continuum = arrays['continuum'][contStart[i]:contStart[i + 1]].reshape(contShape[i])
+    snobj.phases = arrays['phases'][specRows]
+    snobj.phaseType = int(arrays['phaseTypes'][i])
+    snobj.wavelengths = arrays['wavelengths'][arrays['gridInd'][i]]
+    snobj.type = str(arrays['types'][i])
+    snobj.subtype = str(arrays['subtypes'][i])
+    phasekeys = [str(phk) for phk in arrays['phasekeys'][specRows]]
+    snobj.data = snid.SpecTable(flux.T, phasekeys)
+    if not columnar:
+        snobj.toStructured()
+    if 'smoothinfo' in arrays:
+        snobj.smoothinfo = json.loads(str(arrays['smoothinfo'][i]))
+    if 'hasUncertainty' in arrays:
+        for row, phk in zip(specRows, phasekeys):
+            if arrays['hasUncertainty'][row]:
+                snobj.smooth_uncertainty[phk] = arrays['uncertainty'][row]
+    if 'pcaCoeffs' in arrays:
+        snobj.pcaCoeffs = arrays['pcaCoeffs'][i]
+    return snobj
+
+def load(path, mmap_mode=None, columnar=True):
+    """
+    Loads a SNIDdataset object saved with SNIDdataset.save. No pickled
+    objects are read. If mmap_mode is set, the flux block is memory-mapped
+    instead of read into memory, so opening a dataset does not touch the
+    spectra. The spectra of each SNIDsn object are then SpecTable views of
+    the memory-mapped block; use mmap_mode='c' to allow in-place
+    preprocessing without writing to the file.
+
+    Parameters
+    ----------
+    path : string
+    mmap_mode : string
+        None, or numpy.memmap mode for the flux block ('r', 'r+' or 'c').
+    columnar : Boolean
+        Stores the spectra in SpecTables if True, otherwise copies them
+        into structured arrays.
+
+    Returns
+    -------
+    dataset : SNIDdataset object
+
+    """
+    with np.load(path, allow_pickle=False) as npz:
+        version = int(npz['version'])
+        if version > DATASET_FORMAT_VERSION:
+            raise ValueError("%s has dataset format version %i, newest supported is %i"%(path, version, DATASET_FORMAT_VERSION))
+        arrays = {name:npz[name] for name in npz.files if name != 'flux'}
+        if mmap_mode is None:
+            flux = npz['flux']
+    if mmap_mode is not None:
+        flux = memmapNpzMember(path, 'flux', mmap_mode)
+
+    specSN = arrays['specSN']
+    nsn = len(arrays['snnames'])
+    specStart = np.searchsorted(specSN, np.arange(nsn + 1))
+    contStart = continuumOffsets(arrays)
+    dataset = OrderedDict()
+    for i, snname in enumerate(arrays['snnames']):
+        specRows = np.arange(specStart[i], specStart[i + 1])
+        snflux = flux[specStart[i]:specStart[i + 1]]
+        dataset[str(snname)] = snidsnFromArrays(arrays, i, specRows, snflux, contStart, columnar)
+    return dataset
+
+def loadTemplate(lnwfile):
+    """
+    Loads a single SNID template into a SNIDsn object. Any error raised while
+    loading is caught and returned, so that one bad file does not abort
+    loading a whole dataset.
+
+    Parameters
+    ----------
+    lnwfile : string
+        Path to SNID template.
+
+    Returns
+    -------
+    snidObj : SNIDsn object
+        None if loading failed.
+    error : string
+        None if loading succeeded.
+
+    """
+    try:
+        snidObj = snid.SNIDsn()
+        snidObj.loadSNIDlnw(lnwfile)
+        return snidObj, None
+    except Exception as e:
+        return None, '%s: %s'%(type(e).__name__, e)
+
+def loadDataset(pathdir, snlist, nproc=None, chunksize=None, verbose=True, returnFailed=False):
+    """
+    Creates a SNIDdataset object from a list of SNID templates. Templates
+    are loaded in parallel by a pool of nproc worker processes. The order
+    of the dataset always follows the order of snlist. Templates that
+    fail to load are skipped and reported instead of aborting the run.
 
     Parameters
     ----------
     pathdir : string
         Path to SNID template directory
-    snlist : string
-        Path to file with list of SNID templates to load.
+    snlist : string or list
+        Path to file with list of SNID templates to load, or the list
+        of template file names itself.
+    nproc : int
+        Number of worker processes. Default uses all available cpus.
+        nproc=1 loads the templates serially without a process pool.
+    chunksize : int
+        Number of templates sent to a worker at a time. Default splits
+        the list into about 4 chunks per worker.
+    verbose : Boolean
+        Prints progress and a timing report if True.
+    returnFailed : Boolean
+        Also returns the list of templates that failed to load if True.
 
     Returns
     -------
     dataset : SNIDdataset object.
+    failed : list
+        list of (filename, error) tuples. Only returned if returnFailed is True.
 
     """
+    t0 = time.time()
+    if isinstance(snlist, str):
+        with open(snlist) as f:
+            lines = f.readlines()
+            f.close()
+    else:
+        lines = list(snlist)
+    filenames = [sn.strip() for sn in lines if sn.strip() != '']
+    paths = [pathdir+filename for filename in filenames]
+    ntemplates = len(filenames)
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    nproc = max(1, min(nproc, ntemplates))
+    if chunksize is None:
+        chunksize = max(1, int(np.ceil(ntemplates/(4.0*nproc))))
+
+    pool = None
+    if nproc == 1:
+        results = map(loadTemplate, paths)
+    else:
+        pool = multiprocessing.Pool(nproc)
+        results = pool.imap(loadTemplate, paths, chunksize)
+
     dataset = OrderedDict()
-    with open(snlist) as f:
-        lines = f.readlines()
-        f.close()
-    for sn in lines:
-        print(sn)
-        filename = sn.strip()
-        snname = sn.strip().split('.')[0]
-        snidObj = snid.SNIDsn()
-        snidObj.loadSNIDlnw(pathdir+filename)
-        dataset[snname] = snidObj
+    failed = []
+    nreport = max(1, int(np.ceil(ntemplates/10.0)))
+    try:
+        for count, (filename, (snidObj, error)) in enumerate(zip(filenames, results)):
+            if error is None:
+                snname = filename.split('.')[0]
+                dataset[snname] = snidObj
+            else:
+                failed.append((filename, error))
+            if verbose and ((count + 1)%nreport == 0 or count + 1 == ntemplates):
+                print('loaded %i/%i templates (%.1f s)'%(count + 1, ntemplates, time.time() - t0))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if verbose:
+        print('loaded %i templates in %.2f s with %i worker(s), %i failed'\
+              %(len(dataset), time.time() - t0, nproc, len(failed)))
+        for filename, error in failed:
+            print('failed: %s (%s)'%(filename, error))
+    if returnFailed:
+        return dataset, failed
     return dataset
 
+def toColumnar(dataset):
+    """
+    Converts the spectra of every SNIDsn object in dataset to the
+    columnar SpecTable layout.
+
+    Parameters
+    ----------
+    dataset : SNIDdataset object
+
+    Returns
+    -------
+
+    """
+    for snname in list(dataset.keys()):
+        dataset[snname].toColumnar()
+    return
+
+def toStructured(dataset):
+    """
+    Converts the spectra of every SNIDsn object in dataset to
+    structured arrays.
+
+    Parameters
+    ----------
+    dataset : SNIDdataset object
+
+    Returns
+    -------
+
+    """
+    for snname in list(dataset.keys()):
+        dataset[snname].toStructured()
+    return
+
 def deleteSN(dataset, phasekey):
     """
     Deletes a SNIDsn object from the SNIDdataset dictionary.
@@ -121,17 +477,58 @@ def datasetTypeDict(dataset):
     typeinfo : dict
 
     """
+    snnames = np.array(list(dataset.keys()))
+    types = np.array([dataset[sn].type for sn in snnames])
+    uniqueTypes, first, inverse = np.unique(types, return_index=True, return_inverse=True)
+    # keys in order of first appearance in dataset
     typeinfo = dict()
-    for sn in list(dataset.keys()):
-        sntype = dataset[sn].type
-        if sntype in typeinfo:
-            typeinfo[sntype].append(sn)
-        else:
-            typeinfo[sntype] = [sn]
-    for key in list(typeinfo.keys()):
-        typeinfo[key] = np.array(typeinfo[key])
+    for i in np.argsort(first):
+        typeinfo[str(uniqueTypes[i])] = snnames[inverse == i]
     return typeinfo
 
+def datasetTypeCodes(dataset, typeList):
+    """
+    Returns an integer type code for every SN in dataset, in dataset order.
+    The code of a SN is 1 + the index of its type in typeList, and 0 if its
+    type is not in typeList.
+
+    Parameters
+    ----------
+    dataset : SNIDdataset object
+    typeList : list
+        list of SN type strings, e.g. ['IIb', 'Ib', 'Ic', 'IcBL']
+
+    Returns
+    -------
+    codes : np.array
+
+    """
+    types = np.array([dataset[sn].type for sn in dataset.keys()])
+    return typeCodes(types, typeList)
+
+def typeCodes(types, typeList):
+    """
+    Returns an integer type code for every entry of types: 1 + the index of
+    the type in typeList, and 0 if the type is not in typeList.
+
+    Parameters
+    ----------
+    types : np.array
+        array of SN type strings.
+    typeList : list
+        list of SN type strings, e.g. ['IIb', 'Ib', 'Ic', 'IcBL']
+
+    Returns
+    -------
+    codes : np.array
+
+    """
+    types = np.asarray(types)
+    codes = np.zeros(len(types), dtype=int)
+    for i, sntype in enumerate(typeList):
+        codes[types == sntype] = i + 1
+    return codes
+
 def datasetPhaseDict(dataset):
     """
     Returns a dictionary where the keys are the SN names in dataset
@@ -172,6 +569,42 @@ def numSpec(dataset):
         numSpec = numSpec + len(snobj.getSNCols())
     return numSpec
 
+def datasetSpecMatrix(dataset, dtype=np.float64):
+    """
+    Gathers all spectra of dataset into one (nspec, nwvl) matrix, with the
+    spectra of every SN in the order of getSNCols(), and returns index
+    arrays that label every row. The matrix is filled with one concatenate
+    into a preallocated array, copying whole SNe at a time. This is fastest
+    for columnar (SpecTable) datasets, whose spectra are already contiguous.
+
+    Parameters
+    ----------
+    dataset : SNIDdataset object
+    dtype : numpy dtype
+        dtype of the matrix.
+
+    Returns
+    -------
+    specMatrix : np.array
+        (nspec, nwvl) matrix of spectra.
+    snnames : np.array
+        SN name of every row.
+    phasekeys : np.array
+        phase key of every row.
+    types : np.array
+        SN type of every row.
+
+    """
+    snobjs = list(dataset.values())
+    nphases = np.array([len(snobj.getSNCols()) for snobj in snobjs], dtype=int)
+    nwvl = len(snobjs[0].wavelengths)
+    specMatrix = np.empty((nphases.sum(), nwvl), dtype=dtype)
+    np.concatenate([snobj.specMatrix().T for snobj in snobjs], axis=0, out=specMatrix)
+    snnames = np.repeat(np.array(list(dataset.keys())), nphases)
+    phasekeys = np.concatenate([np.asarray(snobj.getSNCols(), dtype=str) for snobj in snobjs])
+    types = np.repeat(np.array([snobj.type for snobj in snobjs]), nphases)
+    return specMatrix, snnames, phasekeys, types
+
 def preprocess(dataset):
     """
     Applies SNIDsn preprocessing to every SN in dataset.
@@ -208,12 +641,109 @@ def snidsetNAN(dataset):
         snobj.snidNAN()
     return
 
+def wavelengthGroups(dataset):
+    """
+    Groups the SNIDsn objects of the dataset by their wavelength arrays.
+
+    Parameters
+    ----------
+    dataset : SNIDdataset object
+
+    Returns
+    -------
+    groups : OrderedDict
+        maps the bytes of each distinct wavelength array to a
+        (wavelengths, list of SN names) tuple.
+
+    """
+    groups = OrderedDict()
+    for snname in list(dataset.keys()):
+        wvl = dataset[snname].wavelengths
+        key = wvl.tobytes()
+        if key not in groups:
+            groups[key] = (wvl, [])
+        groups[key][1].append(snname)
+    return groups
+
+def findDatasetGaps(dataset):
+    """
+    Finds the NaN gaps of every spectrum in the dataset. Spectra that share
+    a wavelength array are run-length encoded together with
+    SNIDsn.findGapsBatch.
+
+    Parameters
+    ----------
+    dataset : SNIDdataset object
+
+    Returns
+    -------
+    snnames : list
+        SN names, in dataset order.
+    snInd : np.array
+        index into snnames of the SN each gap belongs to.
+    phaseInd : np.array
+        index into SNIDsn.getSNCols() of the phase each gap belongs to.
+    gapStart : np.array
+    gapEnd : np.array
+
+    """
+    snnames = list(dataset.keys())
+    snIndex = {snname:i for i, snname in enumerate(snnames)}
+    snInd, phaseInd = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+    gapStart, gapEnd = [np.zeros(0)], [np.zeros(0)]
+    for wvl, groupnames in wavelengthGroups(dataset).values():
+        flux = np.hstack([dataset[snname].specMatrix() for snname in groupnames]).T
+        nphases = np.array([len(dataset[snname].getSNCols()) for snname in groupnames])
+        offsets = np.concatenate(([0], np.cumsum(nphases)))
+        specInd, start, end = snid.findGapsBatch(wvl, flux)
+        groupInd = np.searchsorted(offsets, specInd, side='right') - 1
+        snInd.append(np.array([snIndex[snname] for snname in groupnames], dtype=int)[groupInd])
+        phaseInd.append(specInd - offsets[groupInd])
+        gapStart.append(start)
+        gapEnd.append(end)
+    snInd = np.concatenate(snInd)
+    order = np.argsort(snInd, kind='stable')
+    phaseInd = np.concatenate(phaseInd)[order]
+    gapStart = np.concatenate(gapStart)[order]
+    gapEnd = np.concatenate(gapEnd)[order]
+    return snnames, snInd[order], phaseInd, gapStart, gapEnd
+
+def largeGapPhases(dataset, minwvl, maxwvl, maxgapsize):
+    """
+    Returns the phases of every SNIDsn object in the dataset whose spectra
+    have a gap larger than maxgapsize intersecting the wavelength range.
+
+    Parameters
+    ----------
+    dataset : SNIDdataset object
+    minwvl : float
+        minimum wavelength
+    maxwvl : float
+        maximum wavelength
+    maxgapsize : float
+        maximum gap size tolerable for interpolation (angstroms)
+
+    Returns
+    -------
+    phases : OrderedDict
+        maps each SN name to the list of phase keys with large gaps.
+
+    """
+    snnames, snInd, phaseInd, gapStart, gapEnd = findDatasetGaps(dataset)
+    msk = snid.gapsInRange(gapStart, gapEnd, minwvl, maxwvl, maxgapsize)
+    phases = OrderedDict((snname, []) for snname in snnames)
+    for i, j in sorted(set(zip(snInd[msk], phaseInd[msk]))):
+        phases[snnames[i]].append(dataset[snnames[i]].getSNCols()[j])
+    return phases
+
 def interpGaps(dataset, minwvl, maxwvl, maxgapsize):
     """
     For each SNIDsn object in the dataset, this method removes phases where
     the spectrum has large gaps in the wavelength range of interest. All
     remaining spectra are linearly interpolated in the wavelength region
-    of interest to remove NaN gaps.
+    of interest to remove NaN gaps. Spectra that share a wavelength array
+    are screened and interpolated together with SNIDsn.findGapsBatch and
+    SNIDsn.interpGapsBatch.
 
     Parameters
     ----------
@@ -229,22 +759,62 @@ def interpGaps(dataset, minwvl, maxwvl, maxgapsize):
     -------
 
     """
-    for snname in list(dataset.keys()):
+    for wvl, snnames in wavelengthGroups(dataset).values():
+        flux = np.hstack([dataset[snname].specMatrix() for snname in snnames]).T
+        nphases = [len(dataset[snname].getSNCols()) for snname in snnames]
+        offsets = np.concatenate(([0], np.cumsum(nphases)))
+        specInd, gapStart, gapEnd = snid.findGapsBatch(wvl, flux)
+        largeGap = np.zeros(len(flux), dtype=bool)
+        largeGap[specInd[snid.gapsInRange(gapStart, gapEnd, minwvl, maxwvl, maxgapsize)]] = True
+        keep = np.logical_not(largeGap)
+        if np.any(keep):
+            flux[keep] = snid.interpGapsBatch(wvl, flux[keep], minwvl, maxwvl)
+        for i, snname in enumerate(snnames):
+            snobj = dataset[snname]
+            colnames = snobj.getSNCols()
+            snflux = flux[offsets[i]:offsets[i+1]]
+            snobj.setSpecMatrix(snflux.T)
+            snLargeGap = largeGap[offsets[i]:offsets[i+1]]
+            snobj.removeSpecCols([col for col, lg in zip(colnames, snLargeGap) if lg])
+    return
+
+def restoreContinuum(dataset, spl_a_ind=0, spl_b_ind=-1):
+    """
+    Restores the SNID continuum of all spectra of every SNIDsn object in
+    dataset in one batch. The continuum restored fluxes of each SNIDsn
+    object are stored in its data_unflat attribute, as in
+    SNIDsn.restoreContinuum. The spectra must still be on the full SNID
+    wavelength axis.
+
+    Parameters
+    ----------
+    dataset : SNIDdataset object
+    spl_a_ind : int
+        index of starting knot to use in restoration.
+    spl_b_ind : int
+        index of ending knot to use in restoration.
+
+    Returns
+    -------
+
+    """
+    snnames = list(dataset.keys())
+    knots_x = []
+    knots_y = []
+    fluxes = []
+    nspec = []
+    for snname in snnames:
         snobj = dataset[snname]
-        phases = snobj.phases
-        colnames = snobj.getSNCols()
-        for ph, col in zip(phases, colnames):
-            gaps = snobj.findGaps(col)
-            largeGapInRange = snid.largeGapsInRange(gaps, minwvl, maxwvl, maxgapsize)
-            if largeGapInRange:
-                snobj.removeSpecCol(col)
-            else:
-                wvlmsk = np.logical_and(snobj.wavelengths > minwvl, snobj.wavelengths < maxwvl)
-                wvl = snobj.wavelengths[wvlmsk]
-                wvlStart = wvl[0]
-                wvlEnd = wvl[-1]
-                interpWvlStart, interpWvlEnd = snobj.getInterpRange(wvlStart, wvlEnd, col)
-                snobj.interp1dSpec(col, interpWvlStart, interpWvlEnd)
+        kx, ky = snobj.continuumKnots()
+        flux = snobj.specMatrix()[:,:snobj.header['Nspec']]
+        knots_x.extend(kx)
+        knots_y.extend(ky)
+        fluxes.append(flux)
+        nspec.append(flux.shape[1])
+    data_unflat = snid.restoreContinua(np.hstack(fluxes), knots_x, knots_y, spl_a_ind, spl_b_ind)
+    data_unflat = np.split(data_unflat, np.cumsum(nspec)[:-1], axis=1)
+    for snname, unflat in zip(snnames, data_unflat):
+        dataset[snname].data_unflat = unflat
     return
 
 def datasetWavelengthRange(dataset, minwvl, maxwvl):
@@ -268,7 +838,7 @@ def datasetWavelengthRange(dataset, minwvl, maxwvl):
         snobj.wavelengthFilter(minwvl, maxwvl)
     return
 
-def smoothSpectra(dataset, velcut, velcutIcBL, plot=False):
+def smoothSpectra(dataset, velcut, velcutIcBL, plot=False, batch=False):
     """
     For all SNIDsn objects in dataset, applies SNIDsn smoothing of all spectra.
 
@@ -280,15 +850,20 @@ def smoothSpectra(dataset, velcut, velcutIcBL, plot=False):
     velcutIcBL : float
         velocity cut for SN features of broad line Ic spectra.
     plot : Boolean
-        Plots smoothed spectra if True.
+        Plots smoothed spectra if True. Ignored if batch is True.
+    batch : Boolean
+        Smoothes all spectra with smoothSpectraBatch if True.
 
     Returns
     -------
 
     """
+    if batch:
+        smoothSpectraBatch(dataset, velcut, velcutIcBL)
+        return
     typedict = datasetTypeDict(dataset)
-    nonBL = np.concatenate((typedict['IIb'], typedict['Ib'], typedict['Ic']))
-    BL = typedict['IcBL']
+    nonBL = np.concatenate((typedict.get('IIb', []), typedict.get('Ib', []), typedict.get('Ic', [])))
+    BL = typedict.get('IcBL', [])
     for snname in nonBL:
         snobj = dataset[snname]
         colnames = snobj.getSNCols()
@@ -301,6 +876,54 @@ def smoothSpectra(dataset, velcut, velcutIcBL, plot=False):
             snobj.smoothSpectrum(col, velcutIcBL, plot=plot)
     return
 
+def smoothSpectraBatch(dataset, velcut, velcutIcBL, refine=True):
+    """
+    For all SNIDsn objects in dataset, smoothes all spectra with SNIDsn.smoothBatch.
+    Spectra that share a wavelength array are smoothed together in one call.
+    Stores the separation velocities and uncertainty arrays in the same way
+    as SNIDsn.smoothSpectrum.
+
+    Parameters
+    ----------
+    dataset : SNIDdataset object
+    velcut : float
+        velocity cut for SN features of non broad line type spectra.
+    velcutIcBL : float
+        velocity cut for SN features of broad line Ic spectra.
+    refine : Boolean
+        Refines the power law fits with nonlinear least squares if True.
+        See SNIDsn.smoothBatch.
+
+    Returns
+    -------
+
+    """
+    typedict = datasetTypeDict(dataset)
+    nonBL = np.concatenate((typedict.get('IIb', []), typedict.get('Ib', []), typedict.get('Ic', [])))
+    BL = typedict.get('IcBL', [])
+    groups = OrderedDict()
+    for snnames, cut in [(nonBL, velcut), (BL, velcutIcBL)]:
+        for snname in snnames:
+            snobj = dataset[snname]
+            key = snobj.wavelengths.tobytes()
+            if key not in groups:
+                groups[key] = (snobj.wavelengths, [], [], [])
+            wvl, fluxes, cuts, index = groups[key]
+            for col in snobj.getSNCols():
+                fluxes.append(snobj.data[col])
+                cuts.append(cut)
+                index.append((snobj, col))
+    for wvl, fluxes, cuts, index in groups.values():
+        if len(fluxes) == 0:
+            continue
+        wsmooth, fsmooth, sepvel, fstd = snid.smoothBatch(wvl, np.array(fluxes), np.array(cuts),\
+                                                          unc_arr=True, refine=refine)
+        for i, (snobj, col) in enumerate(index):
+            snobj.smoothinfo[col] = sepvel[i]
+            snobj.smooth_uncertainty[col] = fstd[i]
+            snobj.data[col] = fsmooth[i]
+    return
+
 def plotDataset(dataset, figsize):
     """
     Plots all spectra in the dataset.
@@ -366,6 +989,48 @@ def removeSubType(dataset, subtypename):
             deleteSN(dataset, key)
     return
 
+def selectPhases(phases, phasekeys, phaseRangeList, uniquePhaseFlag):
+    """
+    Returns the phase keys of one SN that filterPhases keeps.
+
+    Parameters
+    ----------
+    phases : np.array
+        phases of the SN.
+    phasekeys : list
+        phase keys of the SN, aligned with phases.
+    phaseRangeList : list
+        list of (minPhase, maxPhase) tuples
+    uniquePhaseFlag : Boolean
+        only keeps phase closest to center of (minPhase, maxPhase) tuple
+        if True. Otherwise keeps all phases in the phase range.
+
+    Returns
+    -------
+    savePhasekeys : np.array
+        sorted unique phase keys to keep.
+
+    """
+    phases = np.asarray(phases)
+    savePhasekeys = []
+    for phaseRange in phaseRangeList:
+        minPh = phaseRange[0]
+        maxPh = phaseRange[1]
+        if uniquePhaseFlag:
+            # only keep one phase per range.
+            centerPh = (minPh + maxPh)/2.0
+            closestInd = np.argmin(np.abs(phases - centerPh))
+            phasekey = phasekeys[closestInd]
+            savePhasekeys.append(phasekey)
+        else:
+            # keep all phases in each range.
+            phmsk = np.logical_and(phases > minPh, phases < maxPh)
+            for phk in np.array(phasekeys)[phmsk]:
+                savePhasekeys.append(phk)
+    savePhasekeys = np.array(savePhasekeys)
+    savePhasekeys = np.unique(savePhasekeys)
+    return savePhasekeys
+
 def filterPhases(dataset, phaseRangeList, uniquePhaseFlag):
     """
     User can specify a list of phase ranges of the form [(minPhase1, maxPhase1), (minPhase2, maxPhase2), ...]
@@ -373,7 +1038,7 @@ def filterPhases(dataset, phaseRangeList, uniquePhaseFlag):
     can be found in one of the specified phase ranges. If uniquePhaseFlag is True, then only one phase
     for each SNIDsn object is chosen for each phase range. The phase that is chosen is the observed phase
     closest to the center of the phase range. If uniquePhaseFlag is False, then all phases that satisfy
-    each phase range are included.
+    each phase range are included. SNIDsn objects left without spectra are deleted from the dataset.
 
     Parameters
     ----------
@@ -390,28 +1055,9 @@ def filterPhases(dataset, phaseRangeList, uniquePhaseFlag):
     """
     for snname in list(dataset.keys()):
         snobj = dataset[snname]
-        phases = snobj.phases
         phasekeys = snobj.getSNCols()
-        savePhasekeys = []
-        for phaseRange in phaseRangeList:
-            minPh = phaseRange[0]
-            maxPh = phaseRange[1]
-            if uniquePhaseFlag:
-                # only keep one phase per range.
-                centerPh = (minPh + maxPh)/2.0
-                closestInd = np.argmin(np.abs(phases - centerPh))
-                phasekey = phasekeys[closestInd]
-                savePhasekeys.append(phasekey)
-            else:
-                # keep all phases in each range.
-                phmsk = np.logical_and(phases > minPh, phases < maxPh)
-                for phk in np.array(phasekeys)[phmsk]:
-                    savePhasekeys.append(phk)
-        savePhasekeys = np.array(savePhasekeys)
-        savePhasekeys = np.unique(savePhasekeys)
-        for phk in phasekeys:
-            if phk not in savePhasekeys:
-                snobj.removeSpecCol(phk)
+        savePhasekeys = selectPhases(snobj.phases, phasekeys, phaseRangeList, uniquePhaseFlag)
+        snobj.removeSpecCols([phk for phk in phasekeys if phk not in savePhasekeys])
         if len(snobj.phases) == 0:
             deleteSN(dataset, snname)
     return
@@ -0,0 +1,404 @@
+import numpy as np
+import SNIDsn as snid
+import SNIDdataset as snidset
+from numpy.lib.format import open_memmap
+from collections import OrderedDict
+import multiprocessing
+import json
+import os
+import time
+
+
+class SNIDlibrary:
+    """
+    Spectral library for large SNID template sets. All template fluxes live in
+    one memory-mapped (nspec, nwvl) float32 matrix, with a side index of the
+    SN names, types, subtypes and phase types of every SN and the phases and
+    phase keys of every spectrum. The filters mirror the SNIDdataset
+    functions of the same name, but return a new SNIDlibrary that shares the
+    flux matrix and index arrays and only holds the indices of the selected
+    spectra. Spectra are read from disk only when they are accessed, e.g.
+    with getFlux or toDataset.
+
+    A library is either a directory written by SNIDlibrary.build, holding
+    flux.npy and index.npz, or a .npz file written by SNIDdataset.save.
+    """
+
+    def __init__(self, flux, arrays, specInd=None):
+        """
+        Parameters
+        ----------
+        flux : np.array
+            (nspec, nwvl) flux matrix, usually a np.memmap.
+        arrays : dict
+            side index arrays, named as in the SNIDdataset.save format.
+        specInd : np.array
+            indices of the spectra in this view. All spectra if None.
+
+        """
+        self.flux = flux
+        self.arrays = arrays
+        if specInd is None:
+            specInd = np.arange(len(arrays['specSN']))
+        self.specInd = np.asarray(specInd, dtype=int)
+        return
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Opens a library directory written by SNIDlibrary.build, or a dataset
+        file written by SNIDdataset.save. The flux matrix is memory-mapped.
+
+        Parameters
+        ----------
+        path : string
+        mmap_mode : string
+            numpy.memmap mode for the flux matrix ('r', 'r+' or 'c').
+
+        Returns
+        -------
+        library : SNIDlibrary
+
+        """
+        if os.path.isdir(path):
+            indexpath = os.path.join(path, 'index.npz')
+            flux = np.load(os.path.join(path, 'flux.npy'), mmap_mode=mmap_mode)
+        else:
+            indexpath = path
+            flux = snidset.memmapNpzMember(path, 'flux', mmap_mode)
+        with np.load(indexpath, allow_pickle=False) as npz:
+            version = int(npz['version'])
+            if version > snidset.DATASET_FORMAT_VERSION:
+                raise ValueError("%s has dataset format version %i, newest supported is %i"\
+                                 %(path, version, snidset.DATASET_FORMAT_VERSION))
+            arrays = {name:npz[name] for name in npz.files if name != 'flux'}
+        return cls(flux, arrays)
+
+    @classmethod
+    def build(cls, path, pathdir, snlist, nproc=None, chunksize=None, verbose=True):
+        """
+        Builds a library directory from the SNID templates listed in the
+        snlist file. The Nspec and Nbins headers are read first to allocate
+        flux.npy, then the templates are parsed in parallel and streamed into
+        it one at a time, so the library never has to fit in memory. Failed
+        templates are skipped as in SNIDdataset.loadDataset.
+
+        Parameters
+        ----------
+        path : string
+            output directory.
+        pathdir : string
+            path to directory containing the .lnw files.
+        snlist : string
+            path to file listing the .lnw files.
+        nproc : int
+            number of worker processes, see SNIDdataset.loadDataset.
+        chunksize : int
+            number of templates sent to a worker at a time.
+        verbose : Boolean
+
+        Returns
+        -------
+        library : SNIDlibrary
+
+        """
+        t0 = time.time()
+        with open(snlist) as f:
+            filenames = [line.strip() for line in f if line.strip() != '']
+        lnwfiles = [pathdir+filename for filename in filenames]
+        nspecTotal = 0
+        nbins = set()
+        for lnwfile in lnwfiles:
+            with open(lnwfile) as lnw:
+                header_items = lnw.readline().split()
+            nspecTotal = nspecTotal + int(header_items[0])
+            nbins.add(int(header_items[1]))
+        if len(nbins) > 1:
+            raise ValueError("templates have different numbers of wavelength bins: %s"%(sorted(nbins)))
+        nwvl = nbins.pop() if len(nbins) == 1 else 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        flux = open_memmap(os.path.join(path, 'flux.npy'), mode='w+', dtype='f4', shape=(nspecTotal, nwvl))
+        index = OrderedDict((name, []) for name in ['snnames', 'types', 'subtypes', 'phaseTypes', 'headers',\
+                                                      'gridInd', 'continuumShape', 'continuum',\
+                                                      'specSN', 'phases', 'phasekeys'])
+        grids = OrderedDict()
+        row = 0
+        if nproc is None:
+            nproc = multiprocessing.cpu_count()
+        nproc = max(1, min(nproc, len(lnwfiles)))
+        if chunksize is None:
+            chunksize = max(1, int(np.ceil(len(lnwfiles)/(4.0*nproc))))
+        pool = None
+        if nproc == 1:
+            results = map(snidset.loadTemplate, lnwfiles)
+        else:
+            pool = multiprocessing.Pool(nproc)
+            results = pool.imap(snidset.loadTemplate, lnwfiles, chunksize)
+        failed = []
+        try:
+            for filename, (snobj, error) in zip(filenames, results):
+                if error is not None:
+                    failed.append((filename, error))
+                    continue
+                colnames = snobj.getSNCols()
+                if row + len(colnames) > nspecTotal:
+                    raise ValueError("%s has more spectra than its Nspec header"%(filename))
+                flux[row:row + len(colnames)] = snobj.specMatrix().T
+                key = snobj.wavelengths.tobytes()
+                if key not in grids:
+                    grids[key] = (len(grids), snobj.wavelengths)
+                i = len(index['snnames'])
+                index['snnames'].append(filename.split('.')[0])
+                index['types'].append(snobj.type)
+                index['subtypes'].append(snobj.subtype)
+                index['phaseTypes'].append(snobj.phaseType)
+                index['headers'].append(json.dumps(snobj.header, default=snidset.jsonDefault))
+                index['gridInd'].append(grids[key][0])
+                index['continuumShape'].append(snobj.continuum.shape)
+                index['continuum'].append(snobj.continuum.ravel())
+                index['specSN'].extend([i]*len(colnames))
+                index['phases'].extend(snobj.phases)
+                index['phasekeys'].extend(colnames)
+                row = row + len(colnames)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        flux.flush()
+        del flux
+
+        arrays = dict()
+        arrays['version'] = np.array(snidset.DATASET_FORMAT_VERSION)
+        arrays['snnames'] = np.array(index['snnames'], dtype=str)
+        arrays['types'] = np.array(index['types'], dtype=str)
+        arrays['subtypes'] = np.array(index['subtypes'], dtype=str)
+        arrays['phaseTypes'] = np.array(index['phaseTypes'], dtype=int)
+        arrays['headers'] = np.array(index['headers'], dtype=str)
+        arrays['wavelengths'] = np.array([wvl for ind, wvl in grids.values()], dtype=np.float64).reshape(len(grids), nwvl)
+        arrays['gridInd'] = np.array(index['gridInd'], dtype=int)
+        arrays['continuumShape'] = np.array(index['continuumShape'], dtype=int).reshape(len(index['snnames']), 2)
+        arrays['continuum'] = np.concatenate(index['continuum']) if len(index['continuum']) > 0 else np.zeros(0)
+        arrays['specSN'] = np.array(index['specSN'], dtype=int)
+        arrays['phases'] = np.array(index['phases'], dtype=np.float64)
+        arrays['phasekeys'] = np.array(index['phasekeys'], dtype=str)
+        np.savez(os.path.join(path, 'index.npz'), **arrays)
+        if verbose:
+            print('built library of %i templates, %i spectra in %.2f s with %i worker(s), %i failed'\
+                  %(len(arrays['snnames']), row, time.time() - t0, nproc, len(failed)))
+            for filename, error in failed:
+                print('failed: %s (%s)'%(filename, error))
+        return cls.load(path)
+
+    def view(self, specInd):
+        """
+        Returns a SNIDlibrary sharing the flux matrix and index arrays that
+        only holds the given spectra.
+
+        Parameters
+        ----------
+        specInd : np.array
+            spectrum indices into the full library.
+
+        Returns
+        -------
+        library : SNIDlibrary
+
+        """
+        return SNIDlibrary(self.flux, self.arrays, specInd)
+
+    def __len__(self):
+        return len(self.specInd)
+
+    def __repr__(self):
+        return 'SNIDlibrary(nsn=%i, nspec=%i)'%(len(self.snnames()), len(self))
+
+    def specSN(self):
+        """
+        Returns the SN index of every spectrum in the view.
+        """
+        return self.arrays['specSN'][self.specInd]
+
+    def snnames(self):
+        """
+        Returns the names of the SNe with spectra in the view.
+        """
+        return self.arrays['snnames'][np.unique(self.specSN())]
+
+    def phases(self):
+        """
+        Returns the phase of every spectrum in the view.
+        """
+        return self.arrays['phases'][self.specInd]
+
+    def phasekeys(self):
+        """
+        Returns the phase key of every spectrum in the view.
+        """
+        return self.arrays['phasekeys'][self.specInd]
+
+    def types(self):
+        """
+        Returns the SN type of every spectrum in the view.
+        """
+        return self.arrays['types'][self.specSN()]
+
+    def subtypes(self):
+        """
+        Returns the SN subtype of every spectrum in the view.
+        """
+        return self.arrays['subtypes'][self.specSN()]
+
+    def wavelengths(self):
+        """
+        Returns the (nspec, nwvl) wavelength array of the spectra in the view.
+        """
+        return self.arrays['wavelengths'][self.arrays['gridInd'][self.specSN()]]
+
+    def getFlux(self):
+        """
+        Reads the (nspec, nwvl) flux rows of the spectra in the view.
+
+        Returns
+        -------
+        flux : np.array
+
+        """
+        return np.asarray(self.flux[self.specInd])
+
+    def typeDict(self):
+        """
+        Returns a dictionary where the keys are the different SN types in the view
+        and the values are arrays of the names of the SNe of the key type.
+        See SNIDdataset.datasetTypeDict.
+
+        Returns
+        -------
+        typeinfo : dict
+
+        """
+        snInd = np.unique(self.specSN())
+        types = self.arrays['types'][snInd]
+        names = self.arrays['snnames'][snInd]
+        return {str(tp):names[types == tp] for tp in np.unique(types)}
+
+    def subset(self, keys):
+        """
+        Returns a view with the spectra of the SNe named in keys.
+
+        Parameters
+        ----------
+        keys : iterable
+
+        Returns
+        -------
+        library : SNIDlibrary
+
+        """
+        snmsk = np.isin(self.arrays['snnames'], list(keys))
+        return self.view(self.specInd[snmsk[self.specSN()]])
+
+    def choosePhaseType(self, phtype):
+        """
+        Returns a view without the SNe that are not of the desired phase type.
+        See SNIDdataset.choosePhaseType.
+
+        Parameters
+        ----------
+        phtype : int
+            Phase type from SNID template
+
+        Returns
+        -------
+        library : SNIDlibrary
+
+        """
+        snmsk = self.arrays['phaseTypes'] == phtype
+        return self.view(self.specInd[snmsk[self.specSN()]])
+
+    def removeSubType(self, subtypename):
+        """
+        Returns a view without the SNe of the specified subtype.
+        See SNIDdataset.removeSubType.
+
+        Parameters
+        ----------
+        subtypename : string
+            Name of subtype to remove
+
+        Returns
+        -------
+        library : SNIDlibrary
+
+        """
+        snmsk = self.arrays['subtypes'] != subtypename
+        return self.view(self.specInd[snmsk[self.specSN()]])
+
+    def filterPhases(self, phaseRangeList, uniquePhaseFlag):
+        """
+        Returns a view with only the spectra observed at phases in one of the
+        phase ranges. If uniquePhaseFlag is True, only the phase of each SN
+        closest to the center of each phase range is kept, otherwise all
+        phases inside each range are kept. SNe without spectra in any of the
+        ranges are not in the returned view, just as SNIDdataset.filterPhases
+        deletes them from the dataset, so snnames() and toDataset() return the
+        same SNe as the filtered dataset.
+
+        Parameters
+        ----------
+        phaseRangeList : list
+            list of (minPhase, maxPhase) tuples
+        uniquePhaseFlag : Boolean
+            only keeps phase closest to center of (minPhase, maxPhase) tuple
+            if True. Otherwise keeps all phases in the phase range.
+
+        Returns
+        -------
+        library : SNIDlibrary
+
+        """
+        specSN = self.specSN()
+        phases = self.phases()
+        keep = np.zeros(len(self.specInd), dtype=bool)
+        order = np.arange(len(self.specInd))
+        for minPh, maxPh in phaseRangeList:
+            if uniquePhaseFlag:
+                # only keep one phase per range.
+                centerPh = (minPh + maxPh)/2.0
+                closest = np.lexsort((order, np.abs(phases - centerPh), specSN))
+                first = np.unique(specSN[closest], return_index=True)[1]
+                keep[closest[first]] = True
+            else:
+                # keep all phases in each range.
+                keep |= np.logical_and(phases > minPh, phases < maxPh)
+        return self.view(self.specInd[keep])
+
+    def toDataset(self, columnar=True):
+        """
+        Reads the spectra in the view into a SNIDdataset object, so the
+        SNIDdataset preprocessing functions can be applied to them.
+
+        Parameters
+        ----------
+        columnar : Boolean
+            Stores the spectra in SpecTables if True, otherwise in structured arrays.
+
+        Returns
+        -------
+        dataset : SNIDdataset object
+
+        """
+        specSN = self.specSN()
+        order = np.argsort(specSN, kind='stable')
+        specInd = self.specInd[order]
+        specSN = specSN[order]
+        flux = self.flux[specInd]
+        snInd, start = np.unique(specSN, return_index=True)
+        end = np.append(start[1:], len(specSN))
+        contStart = snidset.continuumOffsets(self.arrays)
+        dataset = OrderedDict()
+        for i, a, b in zip(snInd, start, end):
+            snname = str(self.arrays['snnames'][i])
+            dataset[snname] = snidset.snidsnFromArrays(self.arrays, i, specInd[a:b], flux[a:b], contStart, columnar)
+        return dataset
@@ -0,0 +1,436 @@
+import numpy as np
+import SNIDsn as snid
+import SNIDdataset as snidset
+import SNIDcache as snidcache
+from numpy.lib.recfunctions import unstructured_to_structured
+from collections import OrderedDict
+import multiprocessing
+import time
+
+
+def runTemplate(args):
+    """
+    Loads a SNID template and runs a pipeline on it. Used by the worker
+    processes of SNIDpipeline.streamTemplates.
+
+    Parameters
+    ----------
+    args : tuple
+        (pipeline, lnwfile, columnar)
+
+    Returns
+    -------
+    snobj : SNIDsn object
+        None if the template failed to load or the pipeline dropped the SN.
+    error : string
+        None if the template was loaded.
+
+    """
+    pipeline, lnwfile, columnar = args
+    snobj, error = snidset.loadTemplate(lnwfile)
+    if error is not None:
+        return None, error
+    if columnar:
+        snobj.toColumnar()
+    return pipeline.apply(snobj), None
+
+
+class SNIDpipeline:
+    """
+    Lazy preprocessing pipeline for SNIDdataset objects. The stage methods
+    have the names of the SNIDdataset functions they replace and only record
+    the stage, so a pipeline is declared by chaining them, e.g.
+
+        pipeline = SNIDpipeline().snidsetNAN().interpGaps(4000, 7000, 20)\
+                   .datasetWavelengthRange(4000, 7000).smoothSpectra(1000, 3000)\
+                   .filterPhases([(-5, 5)], True)
+        dataset = pipeline.run(dataset)
+
+    Nothing is computed until run, stream or apply is called. The stages are
+    then executed fused: each SN is read once into a (nphase, nwvl) flux
+    array, all stages run on that array, and the result is written back to
+    the SNIDsn object once. Spectra removed by interpGaps or filterPhases are
+    dropped as soon as they are rejected, so later stages never touch them,
+    and SNe left without spectra are dropped from the output.
+
+    If optimize is True, the stages are executed in the order returned by
+    plan, which pushes phase filters ahead of the expensive stages, and with
+    margin also wavelength cuts ahead of smoothing.
+    """
+
+    def __init__(self, optimize=True, margin=None):
+        """
+        Parameters
+        ----------
+        optimize : Boolean
+            Executes the stages in the order returned by plan if True,
+            otherwise in the order they were declared.
+        margin : float
+            Wavelength margin (angstroms) kept around a wavelength cut that
+            is pushed ahead of smoothing. None disables the wavelength
+            pushdown. See plan.
+
+        """
+        self.stages = []
+        self.optimize = optimize
+        self.margin = margin
+        return
+
+    def __repr__(self):
+        return 'SNIDpipeline(%s)'%(' -> '.join('%s%s'%(stage, tuple(params)) for stage, params in self.stages))
+
+    def addStage(self, stage, params):
+        self.stages.append((stage, list(params)))
+        return self
+
+    def snidsetNAN(self):
+        """
+        Replaces the SNID 0.0 placeholder values with NaN. See SNIDdataset.snidsetNAN.
+        """
+        return self.addStage('snidsetNAN', [])
+
+    def interpGaps(self, minwvl, maxwvl, maxgapsize):
+        """
+        Removes spectra with large gaps and interpolates the others.
+        See SNIDdataset.interpGaps.
+        """
+        return self.addStage('interpGaps', [minwvl, maxwvl, maxgapsize])
+
+    def datasetWavelengthRange(self, minwvl, maxwvl):
+        """
+        Filters all spectra to the wavelength range. See SNIDdataset.datasetWavelengthRange.
+        """
+        return self.addStage('datasetWavelengthRange', [minwvl, maxwvl])
+
+    def preprocess(self):
+        """
+        Zeros the mean and scales std to 1 for every spectrum. See SNIDdataset.preprocess.
+        """
+        return self.addStage('preprocess', [])
+
+    def smoothSpectra(self, velcut, velcutIcBL, batch=False):
+        """
+        Smooths all spectra of IIb, Ib, Ic and IcBL SNe. See SNIDdataset.smoothSpectra.
+        """
+        return self.addStage('smoothSpectra', [velcut, velcutIcBL, batch])
+
+    def filterPhases(self, phaseRangeList, uniquePhaseFlag):
+        """
+        Keeps only spectra in the phase ranges. See SNIDdataset.filterPhases.
+        """
+        phaseRanges = [list(phaseRange) for phaseRange in phaseRangeList]
+        return self.addStage('filterPhases', [phaseRanges, uniquePhaseFlag])
+
+    def plan(self):
+        """
+        Returns the stages in the order they are executed.
+
+        A filterPhases stage is moved ahead of the smoothSpectra, preprocess,
+        datasetWavelengthRange and snidsetNAN stages before it, which only
+        change the spectra and not which phases exist, so phases that are
+        discarded anyway are never smoothed. It is also moved ahead of
+        interpGaps if uniquePhaseFlag is False, because then every phase is
+        kept or dropped on its own. With uniquePhaseFlag the chosen phase
+        depends on which phases survive interpGaps, so it stays after it.
+        The output is the same as in declaration order, except that
+        SNIDsn.smoothinfo no longer records the phases that are dropped.
+
+        If margin is set, a datasetWavelengthRange(minwvl, maxwvl) stage that
+        follows smoothSpectra (with only phase filters in between) also gets
+        a datasetWavelengthRange(minwvl - margin, maxwvl + margin) stage
+        inserted ahead of the smoothing, so the FFT only touches the pixels
+        that survive plus the margin. Smoothing is not local: the separation
+        velocity is fit over the whole spectrum and the FFT wraps around the
+        ends, so this changes the smoothed fluxes and is only done on request.
+
+        Returns
+        -------
+        stages : list
+            list of (stage, params) tuples.
+
+        """
+        stages = list(self.stages)
+        if not self.optimize:
+            return stages
+        phaseIndependent = ['smoothSpectra', 'preprocess', 'datasetWavelengthRange', 'snidsetNAN']
+        for i in range(len(stages)):
+            if stages[i][0] != 'filterPhases':
+                continue
+            j = i
+            while j > 0:
+                prev = stages[j - 1][0]
+                uniquePhaseFlag = stages[j][1][1]
+                if prev in phaseIndependent or (prev == 'interpGaps' and not uniquePhaseFlag):
+                    stages[j - 1], stages[j] = stages[j], stages[j - 1]
+                    j = j - 1
+                else:
+                    break
+        if self.margin is not None:
+            for i in range(len(stages) - 1, -1, -1):
+                if stages[i][0] != 'datasetWavelengthRange':
+                    continue
+                j = i - 1
+                while j >= 0 and stages[j][0] == 'filterPhases':
+                    j = j - 1
+                if j >= 0 and stages[j][0] == 'smoothSpectra':
+                    minwvl, maxwvl = stages[i][1]
+                    stages.insert(j, ('datasetWavelengthRange', [minwvl - self.margin, maxwvl + self.margin]))
+        return stages
+
+    def apply(self, snobj):
+        """
+        Runs all stages fused on one SNIDsn object, which is updated in place
+        like the SNIDdataset functions do.
+
+        Parameters
+        ----------
+        snobj : SNIDsn object
+
+        Returns
+        -------
+        snobj : SNIDsn object
+            None if no spectra are left.
+
+        """
+        wvl = snobj.wavelengths
+        flux = np.array(snobj.specMatrix().T, dtype='f4', order='C')
+        phasekeys = list(snobj.getSNCols())
+        phases = np.asarray(snobj.phases)
+        removed = []
+        smoothinfo = dict()
+        uncertainty = dict()
+        for stage, params in self.plan():
+            if len(phasekeys) == 0:
+                break
+            keep = None
+            if stage == 'snidsetNAN':
+                flux[flux == 0] = np.nan
+            elif stage == 'interpGaps':
+                minwvl, maxwvl, maxgapsize = params
+                specInd, gapStart, gapEnd = snid.findGapsBatch(wvl, flux)
+                keep = np.ones(len(phasekeys), dtype=bool)
+                keep[specInd[snid.gapsInRange(gapStart, gapEnd, minwvl, maxwvl, maxgapsize)]] = False
+                if np.any(keep):
+                    flux[keep] = snid.interpGapsBatch(wvl, flux[keep], minwvl, maxwvl)
+            elif stage == 'datasetWavelengthRange':
+                minwvl, maxwvl = params
+                wvlfilter = np.logical_and(wvl < maxwvl, wvl > minwvl)
+                wvl = wvl[wvlfilter]
+                flux = np.ascontiguousarray(flux[:,wvlfilter])
+            elif stage == 'preprocess':
+                for i in range(len(phasekeys)):
+                    flux[i] = (flux[i] - np.mean(flux[i]))/np.std(flux[i])
+            elif stage == 'smoothSpectra':
+                velcut, velcutIcBL, batch = params
+                cut = snidcache.smoothVelcut(snobj.type, velcut, velcutIcBL)
+                if cut is None:
+                    continue
+                if batch:
+                    wsmooth, fsmooth, sepvel, fstd = snid.smoothBatch(wvl, flux, cut, unc_arr=True)
+                    flux[:,:] = fsmooth
+                else:
+                    sepvel, fstd = [], []
+                    for i in range(len(phasekeys)):
+                        wsmooth, fsmooth, sv, fs = snid.smooth(wvl, np.copy(flux[i]), cut, unc_arr=True)
+                        flux[i] = fsmooth
+                        sepvel.append(sv)
+                        fstd.append(fs)
+                for i, phk in enumerate(phasekeys):
+                    smoothinfo[phk] = sepvel[i]
+                    uncertainty[phk] = fstd[i]
+            elif stage == 'filterPhases':
+                phaseRangeList, uniquePhaseFlag = params
+                savePhasekeys = snidset.selectPhases(phases, phasekeys, phaseRangeList, uniquePhaseFlag)
+                keep = np.array([phk in savePhasekeys for phk in phasekeys], dtype=bool)
+            else:
+                raise ValueError("unknown stage %s"%(stage))
+            if keep is not None and not np.all(keep):
+                removed.extend([phk for phk, k in zip(phasekeys, keep) if not k])
+                flux = flux[keep]
+                phases = phases[keep]
+                phasekeys = [phk for phk, k in zip(phasekeys, keep) if k]
+                for phk in removed:
+                    uncertainty.pop(phk, None)
+
+        if len(phasekeys) == 0:
+            return None
+        snobj.wavelengths = wvl
+        snobj.phases = phases
+        if snobj.isColumnar():
+            snobj.data = snid.SpecTable(flux.T, phasekeys)
+        else:
+            dtype = np.dtype([(phk, 'f4') for phk in phasekeys])
+            snobj.data = unstructured_to_structured(np.ascontiguousarray(flux.T), dtype=dtype)
+        snobj.smoothinfo.update(smoothinfo)
+        for phk in removed:
+            snobj.smooth_uncertainty.pop(phk, None)
+        snobj.smooth_uncertainty.update(uncertainty)
+        return snobj
+
+    def stream(self, dataset):
+        """
+        Generator that runs the pipeline on one SN of dataset at a time.
+
+        Parameters
+        ----------
+        dataset : SNIDdataset object
+
+        Yields
+        ------
+        snname : string
+        snobj : SNIDsn object
+
+        """
+        for snname in list(dataset.keys()):
+            snobj = self.apply(dataset[snname])
+            if snobj is not None:
+                yield snname, snobj
+
+    def run(self, dataset):
+        """
+        Runs the pipeline on every SN of dataset.
+
+        Parameters
+        ----------
+        dataset : SNIDdataset object
+
+        Returns
+        -------
+        dataset : SNIDdataset object
+            new SNIDdataset holding the SNe that have spectra left.
+
+        """
+        return OrderedDict(self.stream(dataset))
+
+    def cacheKey(self, lnwfile):
+        """
+        Returns the SNIDcache key of the pipeline output for a template. The
+        key chains the template hash with the parameters the SN depends on of
+        the stages in plan() order, in the same way as SNIDcache.buildDataset.
+
+        Parameters
+        ----------
+        lnwfile : string
+
+        Returns
+        -------
+        key : string
+
+        """
+        key = snidcache.stageKey(snidcache.fileHash(lnwfile), 'loadDataset', [])
+        for stage, params in self.plan():
+            if stage == 'smoothSpectra':
+                velcut, velcutIcBL, batch = params
+                sntype = snidcache.templateType(lnwfile)
+                params = [snidcache.smoothVelcut(sntype, velcut, velcutIcBL)]
+                if batch:
+                    params.append(True)
+            key = snidcache.stageKey(key, stage, params)
+        return key
+
+    def streamTemplates(self, pathdir, snlist, nproc=None, chunksize=None, cachedir=None,\
+                        columnar=True, verbose=True):
+        """
+        Generator that loads SNID templates and runs the pipeline on them one
+        at a time, so the whole dataset never has to be in memory. Templates
+        are loaded and processed by a pool of nproc worker processes and
+        yielded in the order of snlist. If cachedir is given, the final
+        pipeline output of every SN is stored in a SNIDcache and reused for
+        unchanged templates and stage parameters.
+
+        Parameters
+        ----------
+        pathdir : string
+            Path to SNID template directory
+        snlist : string or list
+            Path to file with list of SNID templates, or the list itself.
+        nproc : int
+            Number of worker processes. Default uses all available cpus.
+        chunksize : int
+            Number of templates sent to a worker at a time.
+        cachedir : string
+            SNIDcache directory, or None to disable caching.
+        columnar : Boolean
+            Yields spectra stored in SpecTables if True, otherwise in structured arrays.
+        verbose : Boolean
+            Prints a timing report and failed templates if True.
+
+        Yields
+        ------
+        snname : string
+        snobj : SNIDsn object
+
+        """
+        t0 = time.time()
+        if isinstance(snlist, str):
+            with open(snlist) as f:
+                filenames = [line.strip() for line in f if line.strip() != '']
+        else:
+            filenames = [filename.strip() for filename in snlist if filename.strip() != '']
+        cache = snidcache.SNIDcache(cachedir) if cachedir is not None else None
+
+        keys = dict()
+        todo = []
+        for filename in filenames:
+            if cache is not None:
+                keys[filename] = self.cacheKey(pathdir + filename)
+                if cache.has(keys[filename]):
+                    continue
+            todo.append(filename)
+
+        if nproc is None:
+            nproc = multiprocessing.cpu_count()
+        nproc = max(1, min(nproc, len(todo)))
+        if chunksize is None:
+            chunksize = max(1, int(np.ceil(len(todo)/(4.0*nproc))))
+        args = [(self, pathdir + filename, columnar) for filename in todo]
+        pool = None
+        if nproc == 1:
+            results = map(runTemplate, args)
+        else:
+            pool = multiprocessing.Pool(nproc)
+            results = pool.imap(runTemplate, args, chunksize)
+
+        ncached = 0
+        failed = []
+        try:
+            todoSet = set(todo)
+            for filename in filenames:
+                snname = filename.split('.')[0]
+                if filename not in todoSet:
+                    snobj = cache.get(keys[filename])
+                    ncached = ncached + 1
+                    if snobj is not None and not columnar:
+                        snobj.toStructured()
+                else:
+                    snobj, error = next(results)
+                    if error is not None:
+                        failed.append((filename, error))
+                        continue
+                    if cache is not None:
+                        cache.put(keys[filename], snname, snobj)
+                if snobj is not None:
+                    yield snname, snobj
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        if verbose:
+            print('processed %i templates in %.2f s with %i worker(s), %i cached, %i failed'\
+                  %(len(filenames), time.time() - t0, nproc, ncached, len(failed)))
+            for filename, error in failed:
+                print('failed: %s (%s)'%(filename, error))
+        return
+
+    def runTemplates(self, pathdir, snlist, nproc=None, chunksize=None, cachedir=None,\
+                     columnar=True, verbose=True):
+        """
+        Loads SNID templates and runs the pipeline on them. See streamTemplates.
+
+        Returns
+        -------
+        dataset : SNIDdataset object
+
+        """
+        return OrderedDict(self.streamTemplates(pathdir, snlist, nproc, chunksize, cachedir, columnar, verbose))
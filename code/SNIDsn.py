@@ -7,12 +7,33 @@ import scipy.optimize as opt
 from scipy import interpolate
 from scipy.interpolate import CubicSpline
 from scipy.interpolate import interp1d
+from numpy.lib.recfunctions import unstructured_to_structured
+from numpy.lib.recfunctions import structured_to_unstructured
 import matplotlib.pyplot as plt
 import seaborn as sns
 sns.set_color_codes('colorblind')
 
 
 
+# SNID type int -> main type string, and (type int, subtype int) ->
+# (type, subtype) for every subtype SNID defines. Subtypes missing from
+# SNID_SUBTYPES decode to the main type with an empty subtype.
+SNID_TYPES = {1: 'Ia', 2: 'Ib', 3: 'Ic', 4: 'II', 5: ''}
+SNID_SUBTYPES = {
+    (1, 2): ('Ia', 'norm'), (1, 3): ('Ia', '91T'), (1, 4): ('Ia', '91bg'),
+    (1, 5): ('Ia', 'csm'), (1, 6): ('Ia', 'pec'), (1, 7): ('Ia', '99aa'),
+    (1, 8): ('Ia', '02cx'),
+    (2, 2): ('Ib', 'norm'), (2, 3): ('Ib', 'pec'), (2, 4): ('IIb', ''),
+    (2, 5): ('Ib', 'Ibn'), (2, 6): ('Ib', 'Ca'),
+    (3, 2): ('Ic', 'norm'), (3, 3): ('Ic', 'pec'), (3, 4): ('IcBL', ''),
+    (3, 5): ('Ic', 'SL'),
+    (4, 2): ('II', 'P'), (4, 3): ('II', 'pec'), (4, 4): ('II', 'n'),
+    (4, 5): ('II', 'L'),
+    (5, 1): ('NotSN', ''), (5, 2): ('AGN', ''), (5, 3): ('Gal', ''),
+    (5, 4): ('LBV', ''), (5, 5): ('M-star', ''), (5, 6): ('QSO', ''),
+    (5, 7): ('C-star', ''),
+}
+
 def getType(tp, subtp):
     """
     Convert tuple type designation from SNID to string.
@@ -30,84 +51,75 @@ def getType(tp, subtp):
     snsubtype : string
 
     """
-    if tp == 1:
-        sntype = 'Ia'
-        if subtp == 2: 
-            snsubtype = 'norm'
-        elif subtp == 3: 
-            snsubtype = '91T'    
-        elif subtp == 4: 
-            snsubtype = '91bg'
-        elif subtp == 5: 
-            snsubtype = 'csm'
-        elif subtp == 6: 
-            snsubtype = 'pec'
-        elif subtp == 7: 
-            snsubtype = '99aa'
-        elif subtp == 8: 
-            snsubtype = '02cx'
-        else: 
-            snsubtype = ''
-    elif tp == 2:
-        sntype = 'Ib'
-        if subtp == 2: 
-            snsubtype = 'norm'
-        elif subtp == 3: 
-            snsubtype = 'pec'
-        elif subtp == 4:
-            sntype = 'IIb'
-            snsubtype = ''
-        elif subtp == 5: 
-            snsubtype = 'Ibn'
-        elif subtp == 6:
-            snsubtype = 'Ca'
-        else: 
-            snsubtype = ''
-    elif tp == 3:
-        sntype = 'Ic'
-        if subtp == 2: 
-            snsubtype = 'norm'
-        elif subtp == 3: 
-            snsubtype = 'pec'
-        elif subtp == 4:
-            sntype = 'IcBL'
-            snsubtype = ''
-        elif subtp == 5:
-            snsubtype = 'SL'
-        else: 
-            snsubtype = ''
-    elif tp == 4:
-        sntype = 'II'
-        if subtp == 2: 
-            snsubtype = 'P'
-        elif subtp == 3: 
-            snsubtype = 'pec'
-        elif subtp == 4: 
-            snsubtype = 'n'
-        elif subtp == 5: 
-            snsubtype = 'L'
-        else: 
-            snsubtype = ''
-    elif tp == 5:
-        snsubtype = ''
-        if subtp == 1: 
-            sntype = 'NotSN'
-        elif subtp == 2: 
-            sntype = 'AGN'
-        elif subtp == 3: 
-            sntype = 'Gal'
-        elif subtp == 4: 
-            sntype = 'LBV'
-        elif subtp == 5: 
-            sntype = 'M-star'
-        elif subtp == 6: 
-            sntype = 'QSO'
-        elif subtp == 7: 
-            sntype = 'C-star'
-        else: 
-            sntype = ''
-    return sntype, snsubtype
+    tp = int(tp)
+    subtp = int(subtp)
+    if (tp, subtp) in SNID_SUBTYPES:
+        return SNID_SUBTYPES[(tp, subtp)]
+    return SNID_TYPES[tp], ''
+
+
+def findGapsBatch(wvl, fluxes):
+    """
+    Finds all NaN gaps in a stack of spectra sharing the wavelength array wvl
+    by run-length encoding the NaN mask of every spectrum at once.
+
+    Parameters
+    ----------
+    wvl : np.array
+        wavelength array shared by all spectra.
+    fluxes : np.array
+        (nspec, nwvl) array of fluxes, or a single 1D spectrum.
+
+    Returns
+    -------
+    specInd : np.array
+        index of the spectrum each gap belongs to, in increasing order.
+    gapStart : np.array
+        wavelength of the first NaN pixel of each gap.
+    gapEnd : np.array
+        wavelength of the last NaN pixel of each gap.
+
+    """
+    nanmsk = np.isnan(np.atleast_2d(fluxes))
+    nspec, nwvl = nanmsk.shape
+    padded = np.zeros((nspec, nwvl + 2), dtype=np.int8)
+    padded[:,1:-1] = nanmsk
+    edges = np.diff(padded, axis=1)
+    specInd, startInd = np.nonzero(edges == 1)
+    endInd = np.nonzero(edges == -1)[1] - 1
+    return specInd, wvl[startInd], wvl[endInd]
+
+def gapsInRange(gapStart, gapEnd, minwvl, maxwvl, maxgapsize):
+    """
+    Vectorized gap test. Returns a boolean array which is True for every gap
+    at least as large as the maximum acceptable gap size that intersects the
+    specified wavelength range.
+
+    Parameters
+    ----------
+    gapStart : np.array
+        gap start wavelengths.
+    gapEnd : np.array
+        gap end wavelengths.
+    minwvl : float
+        minimum wavelength of wavelength range.
+    maxwvl : float
+        maximum wavelength of wavelength range.
+    maxgapsize : float
+        maximum allowed gap size (angstroms)
+
+    Returns
+    -------
+    msk : np.array
 
+    """
+    gapStart = np.asarray(gapStart, dtype=float)
+    gapEnd = np.asarray(gapEnd, dtype=float)
+    large = gapEnd - gapStart >= maxgapsize
+    overlap = np.logical_and(gapStart < minwvl, gapEnd > maxwvl)
+    overlap |= np.logical_and(gapStart > minwvl, gapStart < maxwvl)
+    overlap |= np.logical_and(gapEnd > minwvl, gapEnd < maxwvl)
+    return np.logical_and(large, overlap)
 
 def largeGapsInRange(gaps, minwvl, maxwvl, maxgapsize):
     """
@@ -130,18 +142,64 @@ def largeGapsInRange(gaps, minwvl, maxwvl, maxgapsize):
     -------
 
     """
-    gapInRange = False
-    for gap in gaps:
-        gapStart = gap[0]
-        gapEnd = gap[1]
-        gapsize = gapEnd - gapStart
-        if maxgapsize > gapsize:
-            continue
-        else:
-            if gapStart < minwvl and gapEnd > maxwvl: gapInRange = True
-            if gapStart > minwvl and gapStart < maxwvl: gapInRange = True
-            if gapEnd > minwvl and gapEnd < maxwvl: gapInRange = True
-    return gapInRange
+    if len(gaps) == 0:
+        return False
+    gaps = np.asarray(gaps, dtype=float)
+    return bool(np.any(gapsInRange(gaps[:,0], gaps[:,1], minwvl, maxwvl, maxgapsize)))
+
+
+def interpGapsBatch(wvl, fluxes, minwvl, maxwvl):
+    """
+    Linearly interpolates the NaN gaps of a stack of spectra sharing the
+    wavelength array wvl, in one pass over the whole (nspec, nwvl) array.
+    For every spectrum the interpolation range is the wavelength range
+    strictly between minwvl and maxwvl, expanded to the nearest finite pixel
+    on each side, as in SNIDdataset.interpGaps with SNIDsn.getInterpRange and
+    SNIDsn.interp1dSpec. Exits with assert error if no finite values exist on
+    one of the sides of the wavelength range. NaN pixels outside the
+    interpolation range are left untouched.
+
+    Parameters
+    ----------
+    wvl : np.array
+        wavelength array shared by all spectra.
+    fluxes : np.array
+        (nspec, nwvl) array of fluxes.
+    minwvl : float
+        minimum wavelength
+    maxwvl : float
+        maximum wavelength
+
+    Returns
+    -------
+    fluxes : np.array
+        copy of fluxes with the gaps interpolated.
+
+    """
+    fluxes = np.array(fluxes, ndmin=2)
+    nspec, nwvl = fluxes.shape
+    rangeInd = np.nonzero(np.logical_and(wvl > minwvl, wvl < maxwvl))[0]
+    startInd = rangeInd[0]
+    endInd = rangeInd[-1]
+    finite = np.isfinite(fluxes)
+    pix = np.arange(nwvl)
+    prevFinite = np.maximum.accumulate(np.where(finite, pix, -1), axis=1)
+    nextFinite = np.minimum.accumulate(np.where(finite, pix, nwvl)[:,::-1], axis=1)[:,::-1]
+    interpStart = prevFinite[:,startInd]
+    interpEnd = nextFinite[:,endInd]
+    assert np.all(interpStart >= 0), "no finite wvl values before %f"%(wvl[startInd + 1])
+    assert np.all(interpEnd < nwvl), "no finite wvl values after %f"%(wvl[endInd - 1])
+
+    gapmsk = np.logical_and(pix >= interpStart[:,np.newaxis], pix <= interpEnd[:,np.newaxis])
+    gapmsk &= np.logical_not(finite)
+    row, col = np.nonzero(gapmsk)
+    left = prevFinite[row, col]
+    right = nextFinite[row, col]
+    frac = (wvl[col] - wvl[left])/(wvl[right] - wvl[left])
+    fleft = fluxes[row, left].astype(np.float64)
+    fright = fluxes[row, right].astype(np.float64)
+    fluxes[row, col] = fleft + frac*(fright - fleft)
+    return fluxes
 
 
 # Binspec implemented in python.
@@ -171,24 +229,95 @@ def binspec(wvl, flux, wstart, wend, wbin):
         rebinned wavelength array
 
     """
+    answer, outlam = binspecBatch(wvl, np.atleast_2d(flux), wstart, wend, wbin)
+    return answer[0], outlam
+
+def binspecBatch(wvl, fluxes, wstart, wend, wbin):
+    """
+    Rebins a matrix of spectra that share the wavelength array wvl. As in the
+    original binspec loop, the fluxes are linearly interpolated onto the union
+    of wvl and the bin edges, and the flux in each output bin is the Simpson
+    integral (scipy.integrate.simps with even='avg') of the points inside the
+    bin divided by the bin size. The points of each bin are the same for all
+    spectra, so the Simpson panels are weighted once and summed for all bins
+    and all spectra at once.
+
+    Parameters
+    ----------
+    wvl : np.array
+        wavelength values (increasing)
+    fluxes : np.array
+        (nspec, nwvl) flux matrix
+    wstart : float
+        desired wavelength start for new binning
+    wend : float
+        desired wavelength end for new binning
+    wbin : float
+        desired bin size
+
+    Returns
+    -------
+    answer/wbin : np.array
+        (nspec, nlam) interpolated fluxes
+    outlam : np.array
+        rebinned wavelength array
+
+    """
+    wvl = np.asarray(wvl, dtype=np.float64)
+    fluxes = np.asarray(fluxes, dtype=np.float64)
     nlam = (wend - wstart) / wbin + 1
     nlam = int(np.ceil(nlam))
     outlam = np.arange(nlam) * wbin + wstart
-    answer = np.zeros(nlam)
-    interplam = np.unique(np.concatenate((wvl, outlam)))
-    interpflux = np.interp(interplam, wvl, flux)
 
-    for i in np.arange(0, nlam - 1):
-        cond = np.logical_and(interplam >= outlam[i], interplam <= outlam[i+1])
-        w = np.where(cond)
-        if len(w) == 2:
-            answer[i] = 0.5*(np.sum(interpflux[cond])*wbin)
-        else:
-            answer[i] = scipy.integrate.simps(interpflux[cond], interplam[cond])
-
-    answer[nlam - 1] = answer[nlam - 2]
+    # linear interpolation of every spectrum onto the union of the input
+    # wavelengths and the bin edges, with the same values as np.interp.
+    interplam = np.unique(np.concatenate((wvl, outlam)))
+    x = np.clip(interplam, wvl[0], wvl[-1])
+    seg = np.clip(np.searchsorted(wvl, x, side='right') - 1, 0, len(wvl) - 2)
+    slope = (fluxes[:,seg + 1] - fluxes[:,seg])/(wvl[seg + 1] - wvl[seg])
+    interpflux = np.where(x == wvl[seg], fluxes[:,seg], slope*(x - wvl[seg]) + fluxes[:,seg])
+    interpflux[:,x == wvl[-1]] = fluxes[:,-1:]
+
+    # points first[i]..last[i] of interplam are in bin i. A NaN spoils only
+    # the bins that contain it, so NaNs are counted separately.
+    first = np.searchsorted(interplam, outlam[:-1])
+    last = np.searchsorted(interplam, outlam[1:])
+    npts = last - first + 1
+    bad = np.logical_not(np.isfinite(interpflux))
+    interpflux[bad] = 0.0
+    cumbad = np.hstack((np.zeros((len(fluxes), 1)), np.cumsum(bad, axis=1)))
+    binbad = cumbad[:,last + 1] - cumbad[:,first] > 0
+
+    # Simpson panel over the points j, j+1, j+2, as in scipy.integrate.simps
+    h = np.diff(interplam)
+    h0 = h[:-1]
+    h1 = h[1:]
+    hsum = h0 + h1
+    h0divh1 = h0/h1
+    panels = hsum/6.0*(interpflux[:,:-2]*(2 - 1.0/h0divh1) + interpflux[:,1:-1]*hsum*hsum/(h0*h1)\
+                       + interpflux[:,2:]*(2 - h0divh1))
+    trapz = 0.5*h*(interpflux[:,1:] + interpflux[:,:-1])
+
+    # For an odd number of points simps adds the panels at even offsets from
+    # the first point of the bin. For an even number it averages the panels at
+    # even offsets plus the last trapezoid with the panels at odd offsets plus
+    # the first trapezoid, which weights every panel of the bin by 1/2.
+    j = np.arange(panels.shape[1])
+    panelBin = np.clip(np.searchsorted(first, j, side='right') - 1, 0, None)
+    offset = j - first[panelBin]
+    inBin = np.logical_and(offset >= 0, offset <= npts[panelBin] - 3)
+    weight = np.where(npts[panelBin] % 2 == 1, (offset % 2 == 0).astype(float), 0.5)*inBin
+    weighted = np.hstack((panels*weight, np.zeros((len(fluxes), 1))))
+
+    answer = np.zeros((len(fluxes), nlam))
+    answer[:,:-1] = np.add.reduceat(weighted, first, axis=1)
+    even = npts % 2 == 0
+    answer[:,:-1][:,even] += 0.5*(trapz[:,first[even]] + trapz[:,last[even] - 1])
+    answer[:,:-1][binbad] = np.nan
+
+    answer[:,nlam - 1] = answer[:,nlam - 2]
     cond = np.logical_or(outlam >= max(wvl), outlam < min(wvl))
-    answer[cond] = 0
+    answer[:,cond] = 0
     return answer/wbin, outlam
 
 #smooth spectrum using SNspecFFTsmooth procedure
@@ -225,11 +354,12 @@ def smooth(wvl, flux, cut_vel, unc_arr=False):
     width = 100
 
     wvl_ln = np.log(wvl)
-    num = wvl_ln.shape[0]
     binsize = wvl_ln[-1] - wvl_ln[-2]
     f_bin, wln_bin = binspec(wvl_ln, flux, min(wvl_ln), max(wvl_ln), binsize)
     fbin_ft = np.fft.fft(f_bin)#*len(f_bin)
-    freq = np.fft.fftfreq(num)
+    # rounding of the wavelengths can make binspec return one bin more or
+    # less than len(wvl), so the frequencies follow the binned spectrum.
+    freq = np.fft.fftfreq(len(f_bin))
     num_upper = np.max(np.where(1.0/freq[1:] * c_kms * binsize > cut_vel))
     num_lower = np.max(np.where(1.0/freq[1:] * c_kms * binsize > vel_toolarge))
     mag_avg = np.mean(np.abs(fbin_ft[num_lower:num_upper+1]))
@@ -268,20 +398,264 @@ def smooth(wvl, flux, cut_vel, unc_arr=False):
 
     if unc_arr:
         f_resi = flux - f_smoothed
-        num = len(f_resi)
-        bin_size = int(np.floor(width/(wvl[1] - wvl[0]))) # window width in number of bins
-        bin_rad = int(np.floor(bin_size / 2))
-        f_std = np.zeros(num)
-        start_ind = bin_rad
-        end_ind = num - bin_rad
-        for j in np.arange(start_ind, end_ind):
-            f_std[j] = np.std(f_resi[j - bin_rad:j + bin_rad + 1])
-        for j in np.arange(1, bin_rad):
-            f_std[j] = np.std(f_resi[0:2*j+1])
-        for j in np.arange(end_ind, num - 1):
-            f_std[j] = np.std(f_resi[2*j - num +1:])
-        f_std[0] = np.abs(f_resi[0])
-        f_std[-1] = np.abs(f_resi[-1])
+        f_std = smoothUncertainty(wvl, f_resi, width)
+        return w_smoothed, f_smoothed, sep_vel, f_std
+
+    return w_smoothed, f_smoothed, sep_vel
+
+def windowStd(x, start, stop):
+    """
+    Standard deviation of x[..., start[j]:stop[j]] for every window j, computed
+    from cumulative sums in O(n) independent of the window sizes. Empty windows
+    give NaN, like np.std.
+
+    Parameters
+    ----------
+    x : np.array
+        (..., n) array. Windows run along the last axis.
+    start : np.array
+        (nwindows,) window start indices
+    stop : np.array
+        (nwindows,) window stop indices (exclusive)
+
+    Returns
+    -------
+    std : np.array
+        (..., nwindows) standard deviations
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    # subtract the mean first so that the sums of squares do not lose precision.
+    x = x - np.mean(x, axis=-1, keepdims=True)
+    zero = np.zeros(x.shape[:-1] + (1,))
+    cs = np.concatenate((zero, np.cumsum(x, axis=-1)), axis=-1)
+    cs2 = np.concatenate((zero, np.cumsum(x*x, axis=-1)), axis=-1)
+    n = stop - start
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (cs[...,stop] - cs[...,start])/n
+        var = (cs2[...,stop] - cs2[...,start])/n - mean*mean
+    var = np.where(n == 1, 0.0, np.maximum(var, 0.0))
+    return np.sqrt(var)
+
+def smoothUncertainty(wvl, f_resi, width=100):
+    """
+    Estimates the uncertainty of smoothed spectra as the standard deviation
+    of the smoothing residuals in a sliding window. The window shrinks
+    symmetrically towards the ends of the spectrum, and the uncertainty of
+    the first and last pixels is the absolute residual.
+
+    Parameters
+    ----------
+    wvl : np.array
+        wavelength array
+    f_resi : np.array
+        residuals between the original and smoothed fluxes, either one
+        spectrum or a (nspec, nwvl) matrix of stacked residuals.
+    width : float
+        window width (angstroms)
+
+    Returns
+    -------
+    f_std : np.array
+        uncertainty array(s), same shape as f_resi.
+
+    """
+    f_resi = np.asarray(f_resi, dtype=np.float64)
+    num = f_resi.shape[-1]
+    bin_size = int(np.floor(width/(wvl[1] - wvl[0]))) # window width in number of bins
+    bin_rad = int(np.floor(bin_size / 2))
+    j = np.arange(num)
+
+    # window [start, stop) of every pixel. Pixels outside every window keep
+    # f_std = 0. The windows are assigned in the same order as the original
+    # loops, so later assignments win where they overlap.
+    start = np.zeros(num, dtype=int)
+    stop = np.zeros(num, dtype=int)
+    msk = np.logical_and(j >= bin_rad, j < num - bin_rad)
+    start[msk] = j[msk] - bin_rad
+    stop[msk] = j[msk] + bin_rad + 1
+    msk = np.logical_and(j >= 1, j < bin_rad)
+    start[msk] = 0
+    stop[msk] = np.minimum(2*j[msk] + 1, num)
+    msk = np.logical_and(j >= num - bin_rad, j < num - 1)
+    start[msk] = 2*j[msk] - num + 1
+    start[msk] = np.where(start[msk] < 0, np.maximum(start[msk] + num, 0), start[msk])
+    stop[msk] = num
+    assigned = stop > 0
+    stop[np.logical_not(assigned)] = 1
+
+    f_std = windowStd(f_resi, start, stop)
+    f_std[...,np.logical_not(assigned)] = 0.0
+    f_std[...,0] = np.abs(f_resi[...,0])
+    f_std[...,-1] = np.abs(f_resi[...,-1])
+    return f_std
+
+def fitPowerlawBatch(x, y, mask, amp_guess, exp_guess, maxiter=100, tol=1e-10):
+    """
+    Least squares fits of y = amp*x**exp to every row of y at once with a
+    Levenberg-Marquardt iteration. The fit of each row only uses the points
+    where mask is True. This finds the same fits as calling
+    scipy.optimize.curve_fit on each row.
+
+    Parameters
+    ----------
+    x : np.array
+        (npoints,) positive x values shared by all rows
+    y : np.array
+        (nrows, npoints) y values
+    mask : np.array
+        (nrows, npoints) boolean array of the points to fit
+    amp_guess : np.array
+        (nrows,) initial amplitudes
+    exp_guess : np.array
+        (nrows,) initial exponents
+    maxiter : int
+    tol : float
+        relative change in the sum of squares at which a fit has converged.
+
+    Returns
+    -------
+    amp : np.array
+    exp : np.array
+
+    """
+    lnx = np.log(np.where(mask, x, 1.0))
+    y = np.where(mask, y, 0.0)
+    w = mask.astype(np.float64)
+    # fit ln(amp) instead of amp so that the amplitude stays positive.
+    p = np.column_stack((np.log(amp_guess), exp_guess))
+    damping = np.full(len(y), 1e-3)
+    model = lambda p: np.exp(p[:,:1] + p[:,1:]*lnx)
+    cost = np.sum(w*(y - model(p))**2, axis=1)
+    done = np.zeros(len(y), dtype=bool)
+    for it in range(maxiter):
+        m = model(p)
+        r = w*(y - m)
+        ja = w*m
+        jb = ja*lnx
+        aa = np.sum(ja*ja, axis=1)
+        ab = np.sum(ja*jb, axis=1)
+        bb = np.sum(jb*jb, axis=1)
+        ga = np.sum(ja*r, axis=1)
+        gb = np.sum(jb*r, axis=1)
+        aa_d = aa*(1 + damping)
+        bb_d = bb*(1 + damping)
+        det = aa_d*bb_d - ab*ab
+        step = np.column_stack(((bb_d*ga - ab*gb)/det, (aa_d*gb - ab*ga)/det))
+        step[np.logical_or(done, np.logical_not(np.isfinite(det)))] = 0.0
+        ptrial = p + step
+        trialcost = np.sum(w*(y - model(ptrial))**2, axis=1)
+        better = trialcost < cost
+        converged = np.logical_and(better, cost - trialcost <= tol*cost)
+        p[better] = ptrial[better]
+        cost[better] = trialcost[better]
+        damping = np.where(better, damping/10.0, damping*10.0)
+        done = np.logical_or(done, np.logical_or(converged, damping > 1e10))
+        if np.all(done):
+            break
+    return np.exp(p[:,0]), p[:,1]
+
+def smoothBatch(wvl, fluxes, cut_vel, unc_arr=False, refine=True):
+    """
+    Smoothes a matrix of spectra that share the wavelength array wvl in Fourier
+    space, using the same method as smooth() for all spectra at once: one
+    batched rebinning, one batched real FFT, vectorized power law fits of the
+    Fourier magnitudes, a masked frequency filter and one batched inverse FFT.
+
+    Parameters
+    ----------
+    wvl : np.array
+        wavelength array
+    fluxes : np.array
+        (nspec, nwvl) flux matrix
+    cut_vel : float or np.array
+        velocity cut for SN features, either one value for all spectra or
+        one value per spectrum. Recommended 1000 km/s for non IcBL spectra
+        and 3000 km/s for IcBL spectra.
+    unc_arr : Boolean
+        Calculates uncertainty arrays if True.
+    refine : Boolean
+        If True the log-space least squares power law fits are refined by a
+        nonlinear least squares fit, as in smooth(). If False the log-space
+        fits are used directly, which is faster but gives separation
+        velocities that can differ substantially from smooth().
+
+    Returns
+    -------
+    w_smoothed : np.array
+        wavelength array for smoothed fluxes
+    f_smoothed : np.array
+        (nspec, nwvl) smoothed flux matrix
+    sepvel : np.array
+        velocities for separating SN features of each spectrum.
+
+    """
+    c_kms = 299792.47 # speed of light in km/s
+    vel_toolarge = 100000 # km/s
+    width = 100
+
+    fluxes = np.atleast_2d(np.asarray(fluxes, dtype=np.float64))
+    nspec = len(fluxes)
+    cut_vel = np.broadcast_to(np.asarray(cut_vel, dtype=np.float64), (nspec,))
+
+    wvl_ln = np.log(wvl)
+    binsize = wvl_ln[-1] - wvl_ln[-2]
+    f_bin, wln_bin = binspecBatch(wvl_ln, fluxes, min(wvl_ln), max(wvl_ln), binsize)
+    num_bin = f_bin.shape[1]
+    fbin_ft = np.fft.rfft(f_bin, axis=1)
+    mag = np.abs(fbin_ft)
+    freq = np.fft.rfftfreq(num_bin)
+    ind = np.arange(len(freq))
+
+    # same frequency ranges as smooth(), which indexes np.fft.fftfreq(num)[1:]
+    vel = 1.0/np.fft.fftfreq(num_bin)[1:] * c_kms * binsize
+    num_upper = len(vel) - 1 - np.argmax((vel[np.newaxis,:] > cut_vel[:,np.newaxis])[:,::-1], axis=1)
+    num_lower = np.max(np.where(vel > vel_toolarge))
+
+    avg_msk = np.logical_and(ind >= num_lower, ind[np.newaxis,:] <= num_upper[:,np.newaxis])
+    mag_avg = np.sum(mag*avg_msk, axis=1)/np.sum(avg_msk, axis=1)
+
+    # closed form log-space least squares fits
+    lnx = np.log(np.where(freq != 0, freq, 1.0))
+    lny = np.log(np.where(mag > 0, mag, 1.0))
+    lin_msk = np.logical_and(avg_msk, ind[np.newaxis,:] < num_upper[:,np.newaxis])
+    lin_msk = np.logical_and(lin_msk, np.logical_and(freq != 0, mag > 0))
+    npts = np.sum(lin_msk, axis=1)
+    xmean = np.sum(lin_msk*lnx, axis=1)/npts
+    ymean = np.sum(lin_msk*lny, axis=1)/npts
+    dx = lin_msk*(lnx - xmean[:,np.newaxis])
+    dy = lin_msk*(lny - ymean[:,np.newaxis])
+    exp_guess = np.sum(dx*dy, axis=1)/np.sum(dx*dx, axis=1)
+    amp_guess = np.exp(ymean - exp_guess*xmean)
+
+    if refine:
+        #do powerlaw fit
+        fit_msk = np.logical_and(ind >= num_lower, ind < int(num_bin/2))
+        fit_msk = np.logical_and(fit_msk, freq != 0)
+        fit_msk = np.logical_and(fit_msk[np.newaxis,:], np.isfinite(mag))
+        ampfit, expfit = fitPowerlawBatch(freq, mag, fit_msk, amp_guess, exp_guess)
+    else:
+        ampfit, expfit = amp_guess, exp_guess
+
+    #find intersection of average fbin_ft magnitude and powerlaw fit to calculate separation
+    #velocity between signal and noise.
+    intersect_x = np.power((mag_avg/ampfit), 1.0/expfit)
+    sep_vel = 1.0/intersect_x * c_kms * binsize
+
+    #filter out frequencies with velocities higher than sep_vel
+    freq_msk = freq[np.newaxis,:] < np.abs(intersect_x)[:,np.newaxis]
+    smooth_fbin_ft_inv = np.fft.irfft(fbin_ft*freq_msk, n=num_bin, axis=1)
+
+    #interpolate smoothed fluxes back onto original wavelengths
+    w_smoothed = np.exp(wln_bin)
+    wvl_clip = np.clip(wvl, w_smoothed[0], w_smoothed[-1])
+    left = np.clip(np.searchsorted(w_smoothed, wvl_clip, side='right') - 1, 0, num_bin - 2)
+    t = (wvl_clip - w_smoothed[left])/(w_smoothed[left + 1] - w_smoothed[left])
+    f_smoothed = smooth_fbin_ft_inv[:,left]*(1 - t) + smooth_fbin_ft_inv[:,left + 1]*t
+
+    if unc_arr:
+        f_resi = fluxes - f_smoothed
+        f_std = smoothUncertainty(wvl, f_resi, width)
         return w_smoothed, f_smoothed, sep_vel, f_std
 
     return w_smoothed, f_smoothed, sep_vel
@@ -333,9 +707,73 @@ def knot_dict(cont):
         d[int(key)] = xyknot_list
     return d
 
+class SNIDgrid:
+    """
+    SNID log-wavelength axis with nw bins between w0 and w1. Holds the bin
+    centers (wvl), bin edges, bin widths (dwbin) and log step (dwlog), and
+    maps continuum knot pixel positions to wavelengths. Use getSNIDgrid to
+    get a cached instance instead of rebuilding the axis. The arrays are
+    read-only because instances are shared.
+    """
+
+    def __init__(self, nw=1024, w0=2500, w1=10000):
+        self.nw = nw
+        self.w0 = w0
+        self.w1 = w1
+        self.dwlog = np.log(w1/w0)/nw
+        self.edges = w0*np.exp(np.arange(nw+1)*self.dwlog)
+        self.dwbin = np.diff(self.edges)
+        self.wvl = 0.5*(self.edges[:-1] + self.edges[1:])
+        self.pix = np.arange(nw) + 1
+        for arr in [self.edges, self.dwbin, self.wvl, self.pix]:
+            arr.setflags(write=False)
+        return
+
+    def __repr__(self):
+        return 'SNIDgrid(nw=%i, w0=%g, w1=%g)'%(self.nw, self.w0, self.w1)
+
+    def knotWavelengths(self, xknot):
+        """
+        Converts continuum knot pixel positions (1 based) to wavelengths by
+        linear interpolation between the bin centers.
+
+        Parameters
+        ----------
+        xknot : float or np.array
+
+        Returns
+        -------
+        wave : float or np.array
+
+        """
+        return np.interp(xknot, self.pix, self.wvl)
+
+_snidGrids = {}
+
+def getSNIDgrid(nw=1024, w0=2500, w1=10000):
+    """
+    Returns the cached SNIDgrid for (nw, w0, w1).
+
+    Parameters
+    ----------
+    nw : int
+    w0 : float
+    w1 : float
+
+    Returns
+    -------
+    grid : SNIDgrid
+
+    """
+    key = (int(nw), float(w0), float(w1))
+    if key not in _snidGrids:
+        _snidGrids[key] = SNIDgrid(nw, w0, w1)
+    return _snidGrids[key]
+
 def snid_wvl_axis():
     """
     Creates the SNID template wavelength axis for restoring the continuum.
+    The arrays are the read-only arrays of the cached getSNIDgrid().
 
     Returns
     -------
@@ -344,18 +782,8 @@ def snid_wvl_axis():
     dwlog : float
 
     """
-    nw = 1024
-    w0 = 2500
-    w1 = 10000
-    dwlog = np.log(w1/w0)/nw
-    wlog = w0*np.exp(np.arange(nw+1)*dwlog)
-    dwbin = np.diff(wlog)
-    new_wlog = []
-    for i in range(nw):
-        el = 0.5*(wlog[i]+wlog[i+1])
-        new_wlog.append(el)
-    new_wlog = np.array(new_wlog)
-    return new_wlog, dwbin, dwlog
+    grid = getSNIDgrid()
+    return grid.wvl, grid.dwbin, grid.dwlog
 
 def convert_xknot_wvl(xknot, nw, wvl):
     """
@@ -364,18 +792,224 @@ def convert_xknot_wvl(xknot, nw, wvl):
 
     Parameters
     ----------
-    xknot : float
+    xknot : float or np.array
     nw : int
     wvl : np.array
 
     Returns
     -------
-    wave : float
+    wave : float or np.array
+
+    """
+    return np.interp(xknot, getSNIDgrid(nw).pix, wvl)
+
+def evalCubicSplines(wvl, knots_x, knots_y):
+    """
+    Fits a cubic spline through the knots of every spectrum and evaluates all
+    of the splines on wvl at once. The splines are the same as
+    scipy.interpolate.CubicSpline(knots_x[i], knots_y[i]), including the
+    extrapolation outside of the knots.
+
+    Parameters
+    ----------
+    wvl : np.array
+        (nwvl,) increasing wavelength array
+    knots_x : list
+        knot x positions (np.array) for each spectrum
+    knots_y : list
+        knot y values (np.array) for each spectrum
+
+    Returns
+    -------
+    y : np.array
+        (nwvl, nspec) splines evaluated on wvl
+
+    """
+    nspec = len(knots_x)
+    nseg = np.array([len(x) - 1 for x in knots_x])
+    maxseg = np.max(nseg)
+    breaks = np.full((nspec, maxseg), np.inf)
+    coefs = np.zeros((4, nspec, maxseg))
+    for i in range(nspec):
+        cs = CubicSpline(knots_x[i], knots_y[i])
+        breaks[i,:nseg[i]] = cs.x[:-1]
+        coefs[:,i,:nseg[i]] = cs.c
+
+    # interval of each wavelength for every spline, from the number of
+    # breakpoints at or below it.
+    first = np.searchsorted(wvl, breaks, side='left')
+    counts = np.zeros((nspec, len(wvl) + 1), dtype=int)
+    np.add.at(counts, (np.repeat(np.arange(nspec), maxseg), first.ravel()), 1)
+    interval = np.cumsum(counts, axis=1)[:,:len(wvl)] - 1
+    interval = np.clip(interval, 0, nseg[:,np.newaxis] - 1)
+
+    rows = np.arange(nspec)[:,np.newaxis]
+    dx = wvl[np.newaxis,:] - breaks[rows, interval]
+    y = coefs[0][rows, interval]
+    for k in range(1, 4):
+        y = y*dx + coefs[k][rows, interval]
+    return y.T
+
+def restoreContinua(flux, knots_x, knots_y, spl_a_ind=0, spl_b_ind=-1):
+    """
+    Restores the SNID continuum of a matrix of flattened spectra on the
+    SNID wavelength axis. All spectra are restored with array operations.
+
+    Parameters
+    ----------
+    flux : np.array
+        (nwvl, nspec) flattened fluxes on the SNID wavelength axis
+    knots_x : list
+        continuum knot wavelengths (np.array) for each spectrum
+    knots_y : list
+        continuum knot fluxes (np.array) for each spectrum
+    spl_a_ind : int
+        index of starting knot to use in restoration.
+    spl_b_ind : int
+        index of ending knot to use in restoration.
+
+    Returns
+    -------
+    data_unflat : np.array
+        (nwvl, nspec) continuum restored fluxes
+
+    """
+    wvl, dwbin, dwlog = snid_wvl_axis()
+    y = evalCubicSplines(wvl, knots_x, [np.log10(ky) for ky in knots_y])
+    unflat = (flux + 1)*np.power(10, y)
+    spl_a = np.array([kx[spl_a_ind] for kx in knots_x])
+    spl_b = np.array([kx[spl_b_ind] for kx in knots_x])
+    msk = np.logical_and(wvl[:,np.newaxis] >= spl_a, wvl[:,np.newaxis] <= spl_b)
+    unflat[np.logical_not(msk)] = 0.0
+    unflat = unflat/dwbin[:,np.newaxis]
+    norm = np.sum(unflat*msk, axis=0)/np.sum(msk, axis=0)
+    return unflat/norm
+
+def parseSNIDlnw(lnwfile):
+    """
+    Parses a .lnw SNID template file in a single pass. The file is read once
+    and the continuum and spectra blocks are each tokenized with one call
+    on the in-memory lines, instead of reading the file again for every block.
+
+    Parameters
+    ----------
+    lnwfile : string
+        path to SNID template file produced by logwave.
+
+    Returns
+    -------
+    header : dict
+        SNID template header
+    continuum : np.array
+        continuum knot lines (including the knot header line)
+    phaseType : int
+    phases : np.array
+    wavelengths : np.array
+    flux : np.array
+        (Nbins, nphases) flux matrix
 
     """
-    pix = np.arange(nw)+1
-    wave = np.interp(xknot,pix,wvl)
-    return wave
+    with open(lnwfile) as lnw:
+        text = lnw.read()
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines = lines[:-1]
+    header_items = lines[0].split()
+    header = dict()
+    header['Nspec'] = int(header_items[0])
+    header['Nbins'] = int(header_items[1])
+    header['WvlStart'] = float(header_items[2])
+    header['WvlEnd'] = float(header_items[3])
+    header['SplineKnots'] = int(header_items[4])
+    header['SN'] = header_items[5]
+    header['dm15'] = float(header_items[6])
+    header['TypeStr'] = header_items[7]
+    header['TypeInt'] = int(header_items[8])
+    header['SubTypeInt'] = int(header_items[9])
+
+    phase_line_ind = len(lines) - header['Nbins'] - 1
+    phase_items = lines[phase_line_ind].split()
+    phaseType = int(phase_items[0])
+    phases = np.array([float(ph) for ph in phase_items[1:]])
+
+    # numpy's C tokenizer works directly on the in-memory lines.
+    continuum = np.loadtxt(lines[1:phase_line_ind], dtype=np.float64, ndmin=2)
+    spec_block = np.loadtxt(lines[phase_line_ind + 1:], dtype=np.float64, ndmin=2)
+    wavelengths = spec_block[:,0].copy()
+    flux = spec_block[:,1:len(phases) + 1]
+    return header, continuum, phaseType, phases, wavelengths, flux
+
+class SpecTable:
+    """
+    Columnar storage for the spectra of a SNIDsn object. The fluxes are kept in
+    one contiguous (nwvl, nphase) array with one column per phase, stored in
+    Fortran order so that every spectrum is contiguous, plus an index from
+    phase key to column. Indexing with a phase key returns a writable view of
+    that column, so code written for the structured array layout
+    (data[phasekey]) keeps working, while operations on the whole object can
+    work on self.flux directly.
+    """
+
+    def __init__(self, flux, names):
+        self.flux = np.asfortranarray(flux)
+        self.names = tuple(names)
+        self.index = {name:i for i, name in enumerate(self.names)}
+        return
+
+    @classmethod
+    def fromStructured(cls, data):
+        """
+        Creates a SpecTable from a structured spectra array.
+
+        Parameters
+        ----------
+        data : np.array
+            structured array with one field per phase.
+
+        Returns
+        -------
+        table : SpecTable
+
+        """
+        return cls(structured_to_unstructured(data), data.dtype.names)
+
+    def toStructured(self):
+        """
+        Returns the spectra as a structured array with one field per phase.
+
+        Returns
+        -------
+        data : np.array
+
+        """
+        return unstructured_to_structured(np.ascontiguousarray(self.flux), dtype=self.dtype)
+
+    @property
+    def dtype(self):
+        """
+        dtype of the equivalent structured array.
+        """
+        return np.dtype([(name, self.flux.dtype.str) for name in self.names])
+
+    def __len__(self):
+        return self.flux.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.flux[:,self.index[key]]
+        if isinstance(key, list) and all(isinstance(k, str) for k in key):
+            return SpecTable(self.flux[:,[self.index[k] for k in key]], key)
+        return SpecTable(self.flux[key], self.names)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, str):
+            self.flux[:,self.index[key]] = value
+        else:
+            self.flux[key] = value
+        return
+
+    def __repr__(self):
+        return 'SpecTable(nwvl=%i, phases=%s)'%(len(self), list(self.names))
 
 class SNIDsn:
     def __init__(self):
@@ -393,7 +1027,7 @@ class SNIDsn:
 
         return
 
-    def loadSNIDlnw(self, lnwfile):
+    def loadSNIDlnw(self, lnwfile, columnar=False):
         """
         Loads the .lnw SNID template file specified by the path lnwfile into
         a SNIDsn object.
@@ -402,40 +1036,22 @@ class SNIDsn:
         ----------
         lnwfile : string
             path to SNID template file produced by logwave.
+        columnar : Boolean
+            Stores the spectra in a SpecTable instead of a structured array if True.
 
         Returns
         -------
 
         """
-        with open(lnwfile) as lnw:
-            lines = lnw.readlines()
-            lnw.close()
-        header_line = lines[0].strip()
-        header_items = header_line.split()
-        header = dict()
-        header['Nspec'] = int(header_items[0])
-        header['Nbins'] = int(header_items[1])
-        header['WvlStart'] = float(header_items[2])
-        header['WvlEnd'] = float(header_items[3])
-        header['SplineKnots'] = int(header_items[4])
-        header['SN'] = header_items[5]
-        header['dm15'] = float(header_items[6])
-        header['TypeStr'] = header_items[7]
-        header['TypeInt'] = int(header_items[8])
-        header['SubTypeInt'] = int(header_items[9])
+        header, continuum, phaseType, phases, wvl, flux = parseSNIDlnw(lnwfile)
         self.header = header
 
         tp, subtp = getType(header['TypeInt'], header['SubTypeInt'])
         self.type = tp
         self.subtype = subtp
 
-        phase_line_ind = len(lines) - self.header['Nbins'] - 1
-        phase_items = lines[phase_line_ind].strip().split()
-        self.phaseType = int(phase_items[0])
-        phases = np.array([float(ph) for ph in phase_items[1:]])
+        self.phaseType = phaseType
         self.phases = phases
-
-        wvl = np.loadtxt(lnwfile, skiprows=phase_line_ind + 1, usecols=0)
         self.wavelengths = wvl
         lnwdtype = []
         colnames = []
@@ -450,20 +1066,85 @@ class SNIDsn:
             colnames.append(colname)
             dt = (colname, 'f4')
             lnwdtype.append(dt)
-        #lnwdtype = [('Ph'+str(ph), 'f4') for ph in self.phases]
-        #print lines[phase_line_ind+1]
-        data = np.loadtxt(lnwfile, dtype=lnwdtype, skiprows=phase_line_ind + 1, usecols=range(1,len(self.phases) + 1))
+        if columnar:
+            data = SpecTable(flux.astype('f4'), colnames)
+        else:
+            data = unstructured_to_structured(flux.astype('f4'), dtype=np.dtype(lnwdtype))
         self.data = data
-
-        continuumcols = len(lines[1].strip().split())
-        continuum = np.ndarray((phase_line_ind - 1,continuumcols))
-        for ind in np.arange(1,phase_line_ind - 0):
-            cont_line = lines[ind].strip().split()
-            #print cont_line
-            continuum[ind - 1] = np.array([float(x) for x in cont_line])
         self.continuum = continuum
         return
 
+    def isColumnar(self):
+        """
+        Returns True if the spectra are stored in a SpecTable.
+
+        Returns
+        -------
+        columnar : Boolean
+
+        """
+        return isinstance(self.data, SpecTable)
+
+    def toColumnar(self):
+        """
+        Converts the spectra from a structured array to a SpecTable.
+
+        Returns
+        -------
+
+        """
+        if not self.isColumnar():
+            self.data = SpecTable.fromStructured(self.data)
+        return
+
+    def toStructured(self):
+        """
+        Converts the spectra from a SpecTable to a structured array.
+
+        Returns
+        -------
+
+        """
+        if self.isColumnar():
+            self.data = self.data.toStructured()
+        return
+
+    def specMatrix(self):
+        """
+        Returns all spectra as a (nwvl, nphase) array. For a SpecTable this is
+        the flux array itself, otherwise the structured array is copied.
+
+        Returns
+        -------
+        flux : np.array
+
+        """
+        if self.isColumnar():
+            return self.data.flux
+        if len(self.getSNCols()) == 0:
+            return np.zeros((len(self.data), 0), dtype='f4')
+        return structured_to_unstructured(self.data)
+
+    def setSpecMatrix(self, flux):
+        """
+        Overwrites all spectra with the columns of a (nwvl, nphase) array,
+        in the order of getSNCols().
+
+        Parameters
+        ----------
+        flux : np.array
+
+        Returns
+        -------
+
+        """
+        if self.isColumnar():
+            self.data.flux[:,:] = flux
+            return
+        for i, col in enumerate(self.getSNCols()):
+            self.data[col] = flux[:,i]
+        return
+
     def preprocess(self, phasekey):
         """
         Zeros the mean and scales std to 1 for the spectrum indicated.
@@ -482,6 +1163,31 @@ class SNIDsn:
         self.data[phasekey] = (self.data[phasekey] - specMean)/specStd
         return
 
+    def continuumKnots(self):
+        """
+        Returns the continuum spline knots of every spectrum, converted
+        to wavelengths and fluxes.
+
+        Returns
+        -------
+        knots_x : list
+            knot wavelengths (np.array) for each spectrum
+        knots_y : list
+            knot fluxes (np.array) for each spectrum
+
+        """
+        nspec = self.header['Nspec']
+        continuum_header = self.continuum[0]
+        continuum = self.continuum[1:]
+        nknots = continuum_header[1::2][:nspec].astype(int)
+        logfmean = continuum_header[2::2][:nspec]
+        xknot = np.power(10, continuum[:,1::2][:,:nspec])
+        yknot = np.power(10, continuum[:,2::2][:,:nspec])*np.power(10, logfmean)
+        xknot_wvl = getSNIDgrid().knotWavelengths(xknot)
+        knots_x = [xknot_wvl[:n,i] for i, n in enumerate(nknots)]
+        knots_y = [yknot[:n,i] for i, n in enumerate(nknots)]
+        return knots_x, knots_y
+
     def restoreContinuum(self, verbose=False, spl_a_ind=0, spl_b_ind=-1):
         """
         Restores the SNID continuum for all spectra. The spectra with the
@@ -499,72 +1205,16 @@ class SNIDsn:
         -------
 
         """
-        continuum_header = self.continuum[0]
-        continuum = self.continuum[1:]
-        if verbose: 
+        if verbose:
             print("continuum lines")
-            print(continuum)
-        nknot_mean_list = knot_meanflux_list(continuum_header)
-        if verbose: 
-            print("nknot mean list")
-            print(nknot_mean_list)
-        xy_knot_dict = knot_dict(continuum)
-        if verbose: print(xy_knot_dict)
-        wvl, dwbin, dwlog = snid_wvl_axis()
-        data_unflat = []
-        for nspec_ind in range(self.header['Nspec']):
-            spline_x = []
-            spline_y = []
-            spline_deg = 3
-            num_splines_spec = int(nknot_mean_list[nspec_ind][0])
-            if verbose:
-                print("num splines for this spectrum")
-                print(num_splines_spec)
-            for spline_ind in np.array(list(xy_knot_dict.keys()))[:num_splines_spec]:
-                pair = xy_knot_dict[spline_ind][nspec_ind]
-                if verbose: 
-                    print("knot pair")
-                    print(pair)
-                xknot = pair[0]
-                yknot = pair[1]
-                xknot = np.power(10,xknot)
-                yknot = np.power(10,yknot)*np.power(10,nknot_mean_list[nspec_ind][1])
-                spline_x.append(xknot)
-                spline_y.append(yknot)
-                if verbose:
-                    print("xknot, yknot")
-                    print(xknot, yknot)
-            spline_x = np.array(spline_x)
-            spline_x_wvl = np.array([convert_xknot_wvl(x,1024,wvl) for x in spline_x])
-            spline_y = np.array(spline_y)
-            if verbose:
-                print("splines")
-                print(spline_x)
-                print(spline_x_wvl)
-                print(spline_y)
-                print(spline_deg)
-            msk = np.logical_and(wvl >= spline_x_wvl[spl_a_ind], wvl <= spline_x_wvl[spl_b_ind])
-            cubicspline = CubicSpline(spline_x_wvl, np.log10(spline_y))
-            y = cubicspline(wvl)
-            if verbose:
-                print("spline eval")
-                print(y)
-                print(np.power(10,y)[1])
-            unflat = []
-            for i in range(len(y)):
-                phkey = self.data.dtype.names[nspec_ind]
-                newf = (self.data[phkey][i]+1)*np.power(10,y[i])
-                #newf = (lnw_dat[i,1]+1)*np.power(10,y[i])
-                unflat.append(newf)
-            if verbose:
-                print("unflat")
-                print(unflat[0:10])
-            unflat = np.array(unflat)
-            zeromsk = np.logical_or(wvl < spline_x_wvl[spl_a_ind], wvl > spline_x_wvl[spl_b_ind])
-            unflat[zeromsk] = 0.0
-            unflat = unflat/dwbin/np.mean(unflat[msk]/dwbin[msk])
-            data_unflat.append(unflat)
-        self.data_unflat = np.array(data_unflat).T
+            print(self.continuum)
+        knots_x, knots_y = self.continuumKnots()
+        if verbose:
+            print("knot wavelengths, fluxes")
+            for kx, ky in zip(knots_x, knots_y):
+                print(kx, ky)
+        flux = self.specMatrix()[:,:self.header['Nspec']]
+        self.data_unflat = restoreContinua(flux, knots_x, knots_y, spl_a_ind, spl_b_ind)
         return
 
         
@@ -603,23 +1253,43 @@ class SNIDsn:
         -------
 
         """
-        newdtype = [(dt[0], dt[1]) for dt in self.data.dtype.descr if dt[0] != colname]
-        newshape = (len(self.data),len(newdtype))
-        ndarr = np.ndarray(newshape)
-        for i in range(len(newdtype)):
-            ndtype = newdtype[i]
-            nm = ndtype[0]
-            ndarr[:,i] = self.data[nm]
-        newstructarr = np.array([tuple(row.tolist()) for row in ndarr], dtype=newdtype)
-        rmInd = np.where(np.array(self.getSNCols()) == colname)[0][0]
-        newphases = []
-        for i in range(len(self.phases)):
-            if i != rmInd:
-                newphases.append(self.phases[i])
-        self.phases = np.array(newphases)
-        self.data = newstructarr
-        if colname in list(self.smooth_uncertainty.keys()):
-            del self.smooth_uncertainty[colname]
+        self.removeSpecCols([colname])
+        return
+
+    def removeSpecCols(self, colnames):
+        """
+        Removes all columns in colnames from the spectra matrix and their
+        phases from the list of phases in one step. For a structured array the
+        remaining fields are kept as a field-subset view of the original array,
+        so no spectra are copied. For a SpecTable the remaining columns are
+        gathered once.
+
+        Parameters
+        ----------
+        colnames : list
+            phases to remove from SNIDsn object.
+
+        Returns
+        -------
+
+        """
+        allcols = self.getSNCols()
+        rmcols = set(colnames)
+        missing = rmcols.difference(allcols)
+        assert len(missing) == 0, "phases not found: %s"%(sorted(missing))
+        if len(rmcols) == 0:
+            return
+        keepmsk = np.array([nm not in rmcols for nm in allcols], dtype=bool)
+        keepcols = [nm for nm in allcols if nm not in rmcols]
+        if self.isColumnar() or len(keepcols) > 0:
+            self.data = self.data[keepcols]
+        else:
+            # an empty field list would select rows instead of fields.
+            self.data = np.zeros(len(self.data), dtype=[])
+        self.phases = np.asarray(self.phases)[keepmsk]
+        for colname in rmcols:
+            if colname in self.smooth_uncertainty:
+                del self.smooth_uncertainty[colname]
         return
 
 
@@ -632,6 +1302,10 @@ class SNIDsn:
         -------
 
         """
+        if self.isColumnar():
+            flux = self.data.flux
+            flux[flux == 0] = np.nan
+            return
         colnames = self.getSNCols()
         for col in colnames:
             self.data[col][self.data[col] == 0] = np.nan
@@ -646,6 +1320,8 @@ class SNIDsn:
         names : np.array
 
         """
+        if self.isColumnar():
+            return self.data.names
         return self.data.dtype.names
 
 
@@ -663,28 +1339,22 @@ class SNIDsn:
             list of (minPhase, maxPhase) tuples for all gaps in spectrum.
 
         """
-        spec = self.data[phase]
-        wvl = self.wavelengths
-        nanind = np.argwhere(np.isnan(spec)).flatten()
-        nanwvl = wvl[np.isnan(spec)]
-        gaps = []
-        if len(nanind) == 0:
-            return gaps
-        gapStartInd = nanind[0]
-        gapStartWvl = nanwvl[0]
-        for i in range(0,len(nanind) - 0):
-            ind = nanind[i]
-            if ind == nanind[-1]:
-                gap = (gapStartWvl, wvl[ind])
-                gaps.append(gap)
-                break
-            nextInd = nanind[i + 1]
-            if ind +1 != nextInd:
-                gap = (gapStartWvl, wvl[ind])
-                gaps.append(gap)
-                gapStartInd = nextInd
-                gapStartWvl = wvl[nextInd]
-        return gaps
+        specInd, gapStart, gapEnd = findGapsBatch(self.wavelengths, self.data[phase])
+        return list(zip(gapStart, gapEnd))
+
+    def findAllGaps(self):
+        """
+        Returns the gaps of all phases at once. See findGapsBatch.
+
+        Returns
+        -------
+        phaseInd : np.array
+            index into getSNCols() of the phase each gap belongs to.
+        gapStart : np.array
+        gapEnd : np.array
+
+        """
+        return findGapsBatch(self.wavelengths, self.specMatrix().T)
     
     def getInterpRange(self, minwvl, maxwvl, phase):
         """
@@ -0,0 +1,209 @@
+import numpy as np
+from SNIDlibrary import SNIDlibrary
+
+
+class SNeIncrementalPCA:
+    """
+    Out-of-core PCA of SNID spectra. Spectra are consumed in chunks and only
+    the number of spectra, the mean spectrum and the centered scatter matrix
+    (nwvl x nwvl) are kept, merged chunk by chunk with the pairwise update of
+    Chan et al. The eigenspectra are the exact eigenvectors of the sample
+    covariance, so they agree with a full SNePCA.snidPCA refit on the same
+    spectra up to round-off, with the same sign convention as
+    sklearn.decomposition.PCA. New SNe can be added with partialFit at any
+    time without revisiting the ones already fitted, also across sessions
+    with save and load.
+    """
+
+    def __init__(self):
+        self.nspec = 0
+        self.mean = None
+        self.scatter = None
+        self.wavelengths = None
+        self.snnames = []
+        return
+
+    def __repr__(self):
+        return 'SNeIncrementalPCA(nsn=%i, nspec=%i)'%(len(self.snnames), self.nspec)
+
+    def partialFitMatrix(self, specMatrix, snnames=None, wavelengths=None):
+        """
+        Adds a chunk of spectra to the accumulated mean and scatter matrix.
+
+        Parameters
+        ----------
+        specMatrix : np.array
+            (nspec, nwvl) matrix of spectra, one spectrum per row.
+        snnames : list
+            names of the SNe in the chunk, recorded as fitted.
+        wavelengths : np.array
+            wavelength array of the spectra.
+
+        Returns
+        -------
+
+        """
+        X = np.asarray(specMatrix, dtype=np.float64)
+        if X.shape[0] == 0:
+            return
+        if self.mean is not None:
+            assert X.shape[1] == len(self.mean), "chunk has %i wavelength bins, fitted spectra have %i"%(X.shape[1], len(self.mean))
+        if self.wavelengths is None and wavelengths is not None:
+            self.wavelengths = np.array(wavelengths, dtype=np.float64)
+        m = X.shape[0]
+        chunkMean = X.mean(axis=0)
+        Xc = X - chunkMean
+        chunkScatter = np.dot(Xc.T, Xc)
+        if self.nspec == 0:
+            self.mean = chunkMean
+            self.scatter = chunkScatter
+        else:
+            n = self.nspec
+            delta = chunkMean - self.mean
+            self.scatter += chunkScatter + np.outer(delta, delta)*(n*m/(n + m))
+            self.mean += delta*(m/(n + m))
+        self.nspec = self.nspec + m
+        if snnames is not None:
+            self.snnames.extend(snnames)
+        return
+
+    def partialFit(self, data, chunksize=1024, skipFitted=True):
+        """
+        Adds the spectra of a SNIDdataset or SNIDlibrary, reading at most
+        chunksize spectra at a time. SNe that were already fitted are
+        skipped if skipFitted is True, so the same growing dataset or
+        library can be passed again after new SNe were added.
+
+        Parameters
+        ----------
+        data : SNIDdataset object or SNIDlibrary
+        chunksize : int
+            maximum number of spectra per chunk.
+        skipFitted : Boolean
+            skip SNe whose names are in self.snnames.
+
+        Returns
+        -------
+        nspec : int
+            number of spectra added.
+
+        """
+        fitted = set(self.snnames) if skipFitted else set()
+        nstart = self.nspec
+        if isinstance(data, SNIDlibrary):
+            specNames = data.arrays['snnames'][data.specSN()]
+            view = data.view(data.specInd[np.logical_not(np.isin(specNames, list(fitted)))])
+            if len(view) == 0:
+                return 0
+            specInd = view.specInd
+            wavelengths = view.wavelengths()[0]
+            newNames = [str(name) for name in view.snnames()]
+            for start in range(0, len(specInd), chunksize):
+                chunk = data.view(specInd[start:start + chunksize])
+                self.partialFitMatrix(chunk.getFlux(), wavelengths=wavelengths)
+            self.snnames.extend(newNames)
+            return self.nspec - nstart
+
+        blocks = []
+        names = []
+        nrows = 0
+        for snname in data.keys():
+            if snname in fitted:
+                continue
+            snobj = data[snname]
+            blocks.append(snobj.specMatrix().T)
+            names.append(snname)
+            nrows = nrows + blocks[-1].shape[0]
+            if nrows >= chunksize:
+                self.partialFitMatrix(np.vstack(blocks), names, snobj.wavelengths)
+                blocks = []
+                names = []
+                nrows = 0
+        if len(names) > 0:
+            self.partialFitMatrix(np.vstack(blocks), names, data[names[0]].wavelengths)
+        return self.nspec - nstart
+
+    def fit(self, n_components=None):
+        """
+        Calculates the PCA eigenspectra of all spectra added so far and
+        stores them in self.evecs, their explained variance ratios in
+        self.evals and self.evals_cs, and the captured variance fraction in
+        self.evalsCaptured, as SNePCA.snidPCA does.
+
+        Parameters
+        ----------
+        n_components : int
+            number of eigenspectra to keep. None keeps min(nspec, nwvl).
+
+        Returns
+        -------
+        evecs : np.array
+        evals : np.array
+
+        """
+        assert self.nspec > 1, "need at least 2 spectra, have %i"%(self.nspec)
+        cov = self.scatter/(self.nspec - 1)
+        w, v = np.linalg.eigh(cov)
+        order = np.argsort(w)[::-1]
+        w = np.clip(w[order], 0, None)
+        evecs = v[:,order].T
+        if n_components is None:
+            n_components = min(self.nspec, len(self.mean))
+        evecs = evecs[:n_components]
+        # same sign convention as sklearn PCA: the largest absolute entry of
+        # every eigenspectrum is positive.
+        maxInd = np.argmax(np.abs(evecs), axis=1)
+        signs = np.sign(evecs[np.arange(len(evecs)), maxInd])
+        self.evecs = evecs*signs[:,np.newaxis]
+        self.evals = w[:n_components]/np.trace(cov)
+        self.evals_cs = self.evals.cumsum()
+        self.evalsCaptured = self.evals_cs[-1]
+        return self.evecs, self.evals
+
+    def save(self, path):
+        """
+        Saves the accumulated state to a .npz file, so fitting can resume
+        in a later session with SNeIncrementalPCA.load.
+
+        Parameters
+        ----------
+        path : string
+
+        Returns
+        -------
+
+        """
+        arrays = dict(nspec=np.array(self.nspec),
+                      snnames=np.array(self.snnames, dtype=str))
+        if self.nspec > 0:
+            arrays['mean'] = self.mean
+            arrays['scatter'] = self.scatter
+        if self.wavelengths is not None:
+            arrays['wavelengths'] = self.wavelengths
+        np.savez(path, **arrays)
+        return
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an accumulated state written by SNeIncrementalPCA.save.
+
+        Parameters
+        ----------
+        path : string
+
+        Returns
+        -------
+        incpca : SNeIncrementalPCA
+
+        """
+        incpca = cls()
+        with np.load(path, allow_pickle=False) as npz:
+            incpca.nspec = int(npz['nspec'])
+            incpca.snnames = [str(name) for name in npz['snnames']]
+            if 'mean' in npz.files:
+                incpca.mean = npz['mean']
+                incpca.scatter = npz['scatter']
+            if 'wavelengths' in npz.files:
+                incpca.wavelengths = npz['wavelengths']
+        return incpca
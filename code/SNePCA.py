@@ -1,5 +1,7 @@
 import SNIDsn
 import SNIDdataset as snid
+from SNIDlibrary import SNIDlibrary
+import SNeSVM
 
 import numpy as np
 import scipy
@@ -30,6 +32,11 @@ import pickle
 from scipy.io.idl import readsav
 import pylab as pl
 
+# SN types with PCA type codes 1-4, see SNePCA.pcaTypeCodes
+SESN_TYPES = ['IIb', 'Ib', 'Ic', 'IcBL']
+
+# version of the SNePCA.saveModel format
+MODEL_FORMAT_VERSION = 1
 
 def readtemplate(tp):
     """
@@ -127,7 +134,30 @@ def plot_contours(ax, clf, xx, yy, alphasvm):
 
 class SNePCA:
 
-    def __init__(self, snidset, phasemin, phasemax):
+    def __init__(self, snidset, phasemin, phasemax, specMatrix=None, pcaNames=None,\
+                 pcaPhases=None, pcaTypes=None, wavelengths=None):
+        """
+        Parameters
+        ----------
+        snidset : SNIDdataset object or SNIDlibrary
+            spectra to analyze. Methods that plot individual SNIDsn objects
+            need a SNIDdataset.
+        phasemin : float
+        phasemax : float
+        specMatrix : np.array
+            prebuilt (nspec, nwvl) matrix of spectra, used as is instead of
+            gathering the spectra of snidset. pcaNames, pcaPhases, pcaTypes
+            and wavelengths must be given with it, and snidset may be None.
+        pcaNames : np.array
+            SN name of every row of specMatrix.
+        pcaPhases : np.array
+            phase key of every row of specMatrix.
+        pcaTypes : np.array
+            SN type of every row of specMatrix.
+        wavelengths : np.array
+            wavelength array of the spectra.
+
+        """
         self.snidset = snidset
         self.phasemin = phasemin
         self.phasemax = phasemax
@@ -143,28 +173,27 @@ class SNePCA:
         self.Ib_ellipse_color = 'mediumorchid'
         self.Ic_ellipse_color = 'r'
         self.IcBL_ellipse_color = 'gray'
-        
-        nspec = snid.numSpec(self.snidset)
-        snnames = list(self.snidset.keys())
-        tmpobj = self.snidset[snnames[0]]
-        nwvlbins = len(tmpobj.wavelengths)
-        self.wavelengths = tmpobj.wavelengths
-
-        specMatrix = np.ndarray((nspec, nwvlbins))
-        pcaNames = []
-        pcaPhases = []
-        count = 0
-        for snname in snnames:
-            snobj = self.snidset[snname]
-            phasekeys = snobj.getSNCols()
-            for phk in phasekeys:
-                specMatrix[count,:] = snobj.data[phk]
-                count = count + 1
-                pcaNames.append(snname)
-                pcaPhases.append(phk)
-        self.pcaNames = np.array(pcaNames)
-        self.pcaPhases = np.array(pcaPhases)
+
+        if specMatrix is None:
+            if isinstance(snidset, SNIDlibrary):
+                specMatrix = np.asarray(snidset.getFlux(), dtype=np.float64)
+                pcaNames = snidset.arrays['snnames'][snidset.specSN()]
+                pcaPhases = snidset.phasekeys()
+                pcaTypes = snidset.types()
+                wavelengths = snidset.wavelengths()[0]
+            else:
+                specMatrix, pcaNames, pcaPhases, pcaTypes = snid.datasetSpecMatrix(snidset)
+                wavelengths = snidset[next(iter(snidset))].wavelengths
+        assert specMatrix.shape[1] == len(wavelengths), "specMatrix has %i wavelength bins, wavelengths has %i"%(specMatrix.shape[1], len(wavelengths))
+        self.wavelengths = wavelengths
         self.specMatrix = specMatrix
+        self.pcaNames = np.asarray(pcaNames)
+        self.pcaPhases = np.asarray(pcaPhases)
+
+        # type code of every spectrum (row of specMatrix): 1 + index in
+        # SESN_TYPES, 0 for other types.
+        self.pcaTypeCodes = snid.typeCodes(pcaTypes, SESN_TYPES)
+        self.typeMasks = None
 
         return
 
@@ -189,39 +218,93 @@ class SNePCA:
 
     def getSNeTypeMasks(self):
         """
+        Returns masks over the spectra (rows of specMatrix) that select each
+        of the 4 major SESN types. The masks are computed once from
+        self.pcaTypeCodes and are read-only.
+
         Returns
         -------
-        Masks that select each of the 4 major SESN types.
+        IIbmask : np.array
+        Ibmask : np.array
+        Icmask : np.array
+        IcBLmask : np.array
 
         """
-        snnames = list(self.snidset.keys())
-        snnames = self.pcaNames
-        typeinfo = snid.datasetTypeDict(self.snidset)
-        IIblist = typeinfo['IIb']
-        Iblist = typeinfo['Ib']
-        Iclist = typeinfo['Ic']
-        IcBLlist = typeinfo['IcBL']
+        if self.typeMasks is None:
+            masks = []
+            for code in range(1, len(SESN_TYPES) + 1):
+                mask = self.pcaTypeCodes == code
+                mask.setflags(write=False)
+                masks.append(mask)
+            self.typeMasks = tuple(masks)
+        return self.typeMasks
 
-        IIbmask = np.in1d(snnames, IIblist)
-        Ibmask = np.in1d(snnames, Iblist)
-        Icmask = np.in1d(snnames, Iclist)
-        IcBLmask = np.in1d(snnames, IcBLlist)
 
-        return IIbmask, Ibmask, Icmask, IcBLmask
+    def snidPCA(self, n_components=None, svd_solver='auto', random_state=None, verbose=False):
+        """
+        Calculates PCA eigenspectra and stores them in self.evecs, and their
+        explained variance ratios in self.evals. With n_components set only
+        the leading eigenspectra are computed, which is much faster for large
+        libraries with the randomized or arpack solvers. The fraction of the
+        total variance captured by the computed eigenspectra is stored in
+        self.evalsCaptured. The plotting routines use up to 5 eigenspectra.
+        The arpack solver agrees with the full solver to round-off, while the
+        randomized solver is approximate: on the Data/DataProducts datasets
+        its leading 5 eigenspectra differ from the full fit by up to ~1e-6
+        per entry, depending on random_state.
 
+        Parameters
+        ----------
+        n_components : int
+            number of eigenspectra to compute. None computes all of them.
+        svd_solver : string
+            'auto', 'full', 'randomized' or 'arpack',
+            see sklearn.decomposition.PCA.
+        random_state : int
+            seed of the randomized solver.
+        verbose : Boolean
+            Prints the captured variance fraction if True.
 
-    def snidPCA(self):
-        """
-        Calculates PCA eigenspectra and stores them in self.evecs
         Returns
         -------
 
         """
-        pca = PCA()
+        pca = PCA(n_components=n_components, svd_solver=svd_solver, random_state=random_state)
         pca.fit(self.specMatrix)
         self.evecs = pca.components_
         self.evals = pca.explained_variance_ratio_
         self.evals_cs = self.evals.cumsum()
+        self.evalsCaptured = self.evals_cs[-1]
+        self.pcaMean = pca.mean_
+        self.evecSigns = np.ones(len(self.evecs), dtype=int)
+        if verbose:
+            print('%i eigenspectra (%s solver) capture %.4f of the variance'%(len(self.evals), svd_solver, self.evalsCaptured))
+        return
+
+    def setEigenspectra(self, incpca, n_components=None):
+        """
+        Stores the eigenspectra of a SNeIncrementalPCA accumulator in
+        self.evecs, self.evals and self.evals_cs instead of fitting
+        self.specMatrix with snidPCA.
+
+        Parameters
+        ----------
+        incpca : SNeIncrementalPCA
+        n_components : int
+            number of eigenspectra to keep. None keeps all of them.
+
+        Returns
+        -------
+
+        """
+        incpca.fit(n_components)
+        assert incpca.evecs.shape[1] == self.specMatrix.shape[1], "eigenspectra have %i wavelength bins, specMatrix has %i"%(incpca.evecs.shape[1], self.specMatrix.shape[1])
+        self.evecs = incpca.evecs
+        self.evals = incpca.evals
+        self.evals_cs = incpca.evals_cs
+        self.evalsCaptured = incpca.evalsCaptured
+        self.pcaMean = incpca.mean
+        self.evecSigns = np.ones(len(self.evecs), dtype=int)
         return
 
     def calcPCACoeffs(self):
@@ -234,9 +317,10 @@ class SNePCA:
         """
         self.pcaCoeffMatrix = np.dot(self.evecs, self.specMatrix.T).T
 
-        for i, snname in enumerate(list(self.snidset.keys())):
-            snobj = self.snidset[snname]
-            snobj.pcaCoeffs = self.pcaCoeffMatrix[i,:]
+        if isinstance(self.snidset, dict):
+            for i, snname in enumerate(list(self.snidset.keys())):
+                snobj = self.snidset[snname]
+                snobj.pcaCoeffs = self.pcaCoeffMatrix[i,:]
         return
 
 
@@ -244,6 +328,254 @@ class SNePCA:
 
 
 
+
+    def transform(self, spectra, wavelengths=None, ids=None, ncomp=None, center=False, wvltol=0.05):
+        """
+        Projects a block of spectra onto the leading eigenspectra with one
+        matrix product. By default the spectra are projected as in
+        calcPCACoeffs, without subtracting the mean, so the coefficients can
+        be compared with self.pcaCoeffMatrix and the SVMs trained on it. With
+        center=True the mean spectrum of the PCA fit is subtracted first, as
+        in sklearn PCA.transform.
+
+        Parameters
+        ----------
+        spectra : np.array
+            (nspec, nwvl) block of spectra, or a single spectrum.
+        wavelengths : np.array
+            wavelength array of the spectra. If given, it must match
+            self.wavelengths to within wvltol.
+        ids : array like
+            identifiers of the spectra, e.g. names. Defaults to the row indices.
+        ncomp : int
+            number of leading eigenspectra to project onto. All if None.
+        center : Boolean
+            subtract the mean spectrum of the PCA fit if True.
+        wvltol : float
+            maximum wavelength mismatch (angstroms). SNID templates store
+            wavelengths to 0.01 angstroms.
+
+        Returns
+        -------
+        coeffs : np.array
+            (nspec, ncomp) PCA coefficients, one row per input spectrum.
+        ids : np.array
+            identifiers of the rows of coeffs.
+
+        """
+        X = np.asarray(spectra, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[np.newaxis,:]
+        nwvl = len(self.wavelengths)
+        assert X.shape[1] == nwvl, "spectra have %i wavelength bins, eigenspectra have %i"%(X.shape[1], nwvl)
+        if wavelengths is not None:
+            assert len(wavelengths) == nwvl, "wavelengths has %i bins, eigenspectra have %i"%(len(wavelengths), nwvl)
+            mismatch = np.max(np.abs(np.asarray(wavelengths) - self.wavelengths))
+            assert mismatch <= wvltol, "wavelength grids differ by up to %.3f angstroms"%(mismatch)
+        assert np.all(np.isfinite(X)), "spectra contain NaN or inf values"
+        if ids is None:
+            ids = np.arange(X.shape[0])
+        ids = np.asarray(ids)
+        assert len(ids) == X.shape[0], "%i ids for %i spectra"%(len(ids), X.shape[0])
+
+        evecs = self.evecs if ncomp is None else self.evecs[:ncomp]
+        coeffs = np.dot(X, evecs.T)
+        if center:
+            coeffs -= np.dot(evecs, self.pcaMean)
+        return coeffs, ids
+
+    def flipSigns(self, signs):
+        """
+        Multiplies the leading eigenspectra by signs (+1 or -1), e.g. to
+        choose the signs of Williamson et al. (2019), and the matching
+        columns of self.pcaCoeffMatrix if it was calculated. The accumulated
+        signs relative to the PCA fit are kept in self.evecSigns and saved
+        with the model.
+
+        Parameters
+        ----------
+        signs : list
+            sign of each of the first len(signs) eigenspectra.
+
+        Returns
+        -------
+
+        """
+        signs = np.asarray(signs, dtype=int)
+        n = len(signs)
+        self.evecs[:n] = self.evecs[:n]*signs[:,np.newaxis]
+        self.evecSigns[:n] = self.evecSigns[:n]*signs
+        if hasattr(self, 'pcaCoeffMatrix'):
+            self.pcaCoeffMatrix[:,:n] = self.pcaCoeffMatrix[:,:n]*signs
+        return
+
+    def calcTypeStatistics(self, ncomp=5, excludeSNe=[]):
+        """
+        Calculates the centroid and standard deviation (ellipse radius for
+        std_rad=1 in pcaPlot) of the PCA coefficients of each SESN type and
+        stores them in self.typeCentroids and self.typeRadii, with one row
+        per type in SESN_TYPES.
+
+        Parameters
+        ----------
+        ncomp : int
+            number of PCA coefficients.
+        excludeSNe : list
+            SNe not to include, see pcaPlot.
+
+        Returns
+        -------
+
+        """
+        nameMask = self.getSNeNameMask(excludeSNe)
+        coeffs = self.pcaCoeffMatrix[:,:ncomp]
+        self.typeCentroids = np.full((len(SESN_TYPES), coeffs.shape[1]), np.nan)
+        self.typeRadii = np.full((len(SESN_TYPES), coeffs.shape[1]), np.nan)
+        for i, mask in enumerate(self.getSNeTypeMasks()):
+            msk = np.logical_and(mask, nameMask)
+            if np.any(msk):
+                self.typeCentroids[i] = np.mean(coeffs[msk], axis=0)
+                self.typeRadii[i] = np.std(coeffs[msk], axis=0)
+        return
+
+    def trainSVM(self, pcs, excludeSNe=[], random_state=0):
+        """
+        Trains a linear SVM on the PCA coefficients of the eigenspectra pcs of
+        all spectra and stores its weights, so predictTypes can classify new
+        spectra without sklearn.
+
+        Parameters
+        ----------
+        pcs : tuple
+            eigenspectrum numbers (1 based), e.g. (1, 5)
+        excludeSNe : list
+            SNe not to train on.
+        random_state : int
+            seed of the LinearSVC solver.
+
+        Returns
+        -------
+        svm : LinearSVC
+
+        """
+        nameMask = self.getSNeNameMask(excludeSNe)
+        self.svmPCs = np.asarray(pcs, dtype=int)
+        svm = LinearSVC(random_state=random_state)
+        svm.fit(self.pcaCoeffMatrix[nameMask][:,self.svmPCs - 1], self.pcaTypeCodes[nameMask])
+        self.svmCoef = svm.coef_
+        self.svmIntercept = svm.intercept_
+        self.svmClasses = svm.classes_
+        return svm
+
+    def predictTypes(self, coeffs):
+        """
+        Predicts the SESN type of spectra from their PCA coefficients (see
+        transform) with the SVM weights stored by trainSVM or loadModel.
+
+        Parameters
+        ----------
+        coeffs : np.array
+            (nspec, ncomp) PCA coefficients.
+
+        Returns
+        -------
+        types : np.array
+            predicted type of every spectrum, 'other' for type code 0.
+
+        """
+        X = np.atleast_2d(coeffs)[:,self.svmPCs - 1]
+        decision = np.dot(X, self.svmCoef.T) + self.svmIntercept
+        if len(self.svmClasses) == 2:
+            codes = self.svmClasses[(decision[:,0] > 0).astype(int)]
+        else:
+            codes = self.svmClasses[np.argmax(decision, axis=1)]
+        return np.array(['other'] + SESN_TYPES)[codes]
+
+    def saveModel(self, path, ncomp=None):
+        """
+        Saves the trained model to a versioned .npz file: the wavelength grid,
+        the mean spectrum, the leading eigenspectra with their explained
+        variance ratios and signs, and, if calculated, the type centroids and
+        radii and the SVM weights. Load it with SNePCA.loadModel.
+
+        Parameters
+        ----------
+        path : string
+        ncomp : int
+            number of eigenspectra to save. All if None.
+
+        Returns
+        -------
+
+        """
+        ncomp = len(self.evecs) if ncomp is None else ncomp
+        arrays = dict(version=np.array(MODEL_FORMAT_VERSION),
+                      phaseRange=np.array([self.phasemin, self.phasemax], dtype=float),
+                      types=np.array(SESN_TYPES),
+                      wavelengths=np.asarray(self.wavelengths, dtype=np.float64),
+                      pcaMean=self.pcaMean,
+                      evecs=self.evecs[:ncomp],
+                      evals=self.evals[:ncomp],
+                      evecSigns=self.evecSigns[:ncomp])
+        if hasattr(self, 'typeCentroids'):
+            arrays['typeCentroids'] = self.typeCentroids
+            arrays['typeRadii'] = self.typeRadii
+        if hasattr(self, 'svmCoef'):
+            arrays['svmPCs'] = self.svmPCs
+            arrays['svmCoef'] = self.svmCoef
+            arrays['svmIntercept'] = self.svmIntercept
+            arrays['svmClasses'] = self.svmClasses
+        np.savez(path, **arrays)
+        return
+
+    @classmethod
+    def loadModel(cls, path):
+        """
+        Loads a model saved with SNePCA.saveModel. The model holds no
+        training spectra, so only transform, predictTypes and the stored
+        statistics are available.
+
+        Parameters
+        ----------
+        path : string
+
+        Returns
+        -------
+        model : SNePCA
+
+        """
+        with np.load(path, allow_pickle=False) as npz:
+            version = int(npz['version'])
+            if version > MODEL_FORMAT_VERSION:
+                raise ValueError("%s has model format version %i, newest supported is %i"\
+                                 %(path, version, MODEL_FORMAT_VERSION))
+            assert list(npz['types']) == SESN_TYPES, "model type codes %s differ from %s"%(list(npz['types']), SESN_TYPES)
+            arrays = {name:npz[name] for name in npz.files}
+        wavelengths = arrays['wavelengths']
+        phasemin, phasemax = arrays['phaseRange']
+        model = cls(None, phasemin, phasemax, specMatrix=np.empty((0, len(wavelengths))),\
+                    pcaNames=np.array([], dtype=str), pcaPhases=np.array([], dtype=str),\
+                    pcaTypes=np.array([], dtype=str), wavelengths=wavelengths)
+        model.pcaMean = arrays['pcaMean']
+        model.evecs = arrays['evecs']
+        model.evals = arrays['evals']
+        model.evals_cs = model.evals.cumsum()
+        model.evalsCaptured = model.evals_cs[-1]
+        model.evecSigns = arrays['evecSigns']
+        if 'typeCentroids' in arrays:
+            model.typeCentroids = arrays['typeCentroids']
+            model.typeRadii = arrays['typeRadii']
+        if 'svmCoef' in arrays:
+            model.svmPCs = arrays['svmPCs']
+            model.svmCoef = arrays['svmCoef']
+            model.svmIntercept = arrays['svmIntercept']
+            model.svmClasses = arrays['svmClasses']
+        return model
+
+
+
+
+
     def reconstructSpectrumGrid(self, figsize, snname, phasekey,
                                 Nhostgrid, nPCAComponents, fontsize,
                                 leg_fontsize, ylim=(-2,2), dytick=1):
@@ -628,7 +960,7 @@ class SNePCA:
 
 
         if svm:
-            truth = 1*IIbMask + 2*IbMask + 3*IcMask + 4*IcBLMask
+            truth = self.pcaTypeCodes
             dat = np.column_stack((x,y))
             linsvm = LinearSVC()
 
@@ -977,7 +1309,66 @@ class SNePCA:
         fig = go.Figure(data=data, layout=layout)
         return fig
 
-    def cornerplotPCA(self, ncomp, figsize, svm=False, ncv=1):
+    def svmPairScores(self, ncomp, ncv=1, nproc=1, seed=0):
+        """
+        Calculates the cross validated SVM scores of the 2D marginalizations
+        of the first ncomp PCA components in parallel, without plotting.
+        See SNeSVM.svmPairScores.
+
+        Parameters
+        ----------
+        ncomp : int
+            Number of PCA components
+        ncv : int
+            Number of cross validation runs
+        nproc : int
+            Number of worker processes, all cores if None
+        seed : int
+            Seed of the cross validation splits
+
+        Returns
+        -------
+        means_table : np.array
+            average svm scores of the 2D marginalizations
+        std_table : np.array
+            standard deviations of svm scores for
+            the 2D marginalizations
+
+        """
+        return SNeSVM.svmPairScores(self.pcaCoeffMatrix, self.pcaTypeCodes, ncomp, ncv, nproc=nproc, seed=seed)
+
+    def svmSubspaceSearch(self, maxk, ncomp=None, ncv=50, nproc=None, seed=0, checkpoint=None, **kwargs):
+        """
+        Searches all subsets of up to maxk of the first ncomp PCA components
+        for the best cross validated SVM score, with pruning, parallel fits
+        and checkpointing. See SNeSVM.subspaceSearch for the other arguments.
+
+        Parameters
+        ----------
+        maxk : int
+            largest number of PCA components in a subset
+        ncomp : int
+            Number of leading PCA components to choose from
+        ncv : int
+            Number of cross validation runs
+        nproc : int
+            Number of worker processes
+        seed : int
+            Seed of the cross validation splits
+        checkpoint : string
+            path of the checkpoint file
+
+        Returns
+        -------
+        results : list
+            scored subsets ordered by decreasing average score, with the
+            pruned subsets last
+
+        """
+        return SNeSVM.subspaceSearch(self.pcaCoeffMatrix, self.pcaTypeCodes, maxk, ncomp=ncomp, ncv=ncv,\
+                                     nproc=nproc, seed=seed, checkpoint=checkpoint, **kwargs)
+
+    def cornerplotPCA(self, ncomp, figsize, svm=False, ncv=1, nproc=1, seed=0):
         """
         Plots the 2D marginalizations of the PCA decomposition in a corner plot.
 
@@ -990,6 +1381,10 @@ class SNePCA:
             Calculates SVM scores if True
         ncv : int
             Number of cross validation runs
+        nproc : int
+            Number of worker processes for the SVM scores, all cores if None
+        seed : int
+            Seed of the cross validation splits
 
         Returns
         -------
@@ -1000,9 +1395,9 @@ class SNePCA:
             x ind of best pca component
         svm_y : int
             y ind of best pca component
-        means_table : pandas Data Table
+        means_table : np.array
             average svm scores of the 2D marginalizations
-        std_table : pandas Data Table
+        std_table : np.array
             standard deviations of svm scores for
             the 2D marginalizations
 
@@ -1017,8 +1412,8 @@ class SNePCA:
         svm_x = -1
         svm_y = -1
 
-        means_table = np.zeros((ncomp,ncomp))
-        std_table = np.zeros((ncomp,ncomp))
+        if svm:
+            means_table, std_table = self.svmPairScores(ncomp, ncv, nproc=nproc, seed=seed)
         f = plt.figure(figsize=figsize)
         for i in range(ncomp):
             for j in range(ncomp):
@@ -1044,23 +1439,7 @@ class SNePCA:
                     plt.scatter(IcBLxmean, IcBLymean, color=self.IcBL_color, alpha=0.5, s=100)
 
                     if svm:
-                        truth = 1*IIbMask + 2*IbMask + 3*IcMask + 4*IcBLMask
-                        dat = np.column_stack((x,y))
-
-                        ncv_scores=[]
-                        for cvit in range(ncv):
-                            trainX, testX, trainY, testY = train_test_split(dat, truth, test_size=0.3)
-                            linsvm = LinearSVC()
-                            linsvm.fit(trainX, trainY)
-                            score = linsvm.score(testX, testY)
-                            ncv_scores.append(score)
-                        score = np.mean(ncv_scores)
-                        std = np.std(ncv_scores)
-                        means_table[j,i] = score
-                        means_table[i,j] = score
-                        std_table[j,i] = std
-                        std_table[i,j] = std
-
+                        score = means_table[i,j]
                         if score > svm_highscore:
                             svm_highscore = score
                             svm_x = j+1
@@ -0,0 +1,377 @@
+import numpy as np
+from sklearn.svm import LinearSVC
+from sklearn.model_selection import train_test_split
+import multiprocessing
+import itertools
+import hashlib
+import json
+import os
+
+
+def cvSplits(nsamples, ncv, test_size=0.3, seed=0):
+    """
+    Returns ncv random train/test splits of nsamples samples, drawn as in
+    SNePCA.cornerplotPCA but seeded, so scores are reproducible and every
+    subspace scored with the same splits is compared on the same folds.
+    Split k uses seed + k for the split and for the LinearSVC solver.
+
+    Parameters
+    ----------
+    nsamples : int
+    ncv : int
+        number of cross validation runs.
+    test_size : float
+        fraction of samples in the test set.
+    seed : int
+
+    Returns
+    -------
+    splits : list
+        list of (train indices, test indices, seed) tuples.
+
+    """
+    ind = np.arange(nsamples)
+    splits = []
+    for k in range(ncv):
+        train, test = train_test_split(ind, test_size=test_size, random_state=seed + k)
+        splits.append((train, test, seed + k))
+    return splits
+
+# coefficients, type codes and splits of the fits run by this process, set
+# by initWorker, so that they are sent to every worker once per pool.
+_workerData = dict()
+
+def initWorker(coeffs, truth, splits):
+    """
+    Stores the data that scoreFold fits in the current process. Used as the
+    initializer of the pools created by scorePool.
+
+    Parameters
+    ----------
+    coeffs : np.array
+        (nspec, ncomp) PCA coefficients.
+    truth : np.array
+        type code of every spectrum.
+    splits : list
+        see cvSplits.
+
+    Returns
+    -------
+
+    """
+    _workerData['coeffs'] = coeffs
+    _workerData['truth'] = truth
+    _workerData['splits'] = splits
+    return
+
+def scorePool(coeffs, truth, splits, nproc):
+    """
+    Returns a multiprocessing.Pool of nproc workers that already hold coeffs,
+    truth and splits, so that it can be passed to scoreSubspaces for any
+    number of calls on the same data without sending the data again. The
+    caller closes the pool.
+
+    Parameters
+    ----------
+    coeffs : np.array
+    truth : np.array
+    splits : list
+        see cvSplits.
+    nproc : int
+
+    Returns
+    -------
+    pool : multiprocessing.Pool
+
+    """
+    return multiprocessing.Pool(nproc, initWorker, (coeffs, truth, splits))
+
+def scoreFold(args):
+    """
+    Fits a LinearSVC on the training samples of one split and returns its
+    test score. Used by the worker processes of scoreSubspaces, the data is
+    set by initWorker.
+
+    Parameters
+    ----------
+    args : tuple
+        (subspace column indices, split index)
+
+    Returns
+    -------
+    score : float
+
+    """
+    cols, k = args
+    train, test, seed = _workerData['splits'][k]
+    X = _workerData['coeffs'][:,list(cols)]
+    truth = _workerData['truth']
+    linsvm = LinearSVC(random_state=seed)
+    linsvm.fit(X[train], truth[train])
+    return linsvm.score(X[test], truth[test])
+
+def scoreSubspaces(coeffs, truth, subspaces, splits, splitInd=None, nproc=1, pool=None, chunksize=None):
+    """
+    Scores linear SVMs on every (subspace, split) combination, spread over
+    a pool of nproc worker processes. The scores do not depend on nproc.
+    A single fit takes milliseconds, so small jobs such as the pair scores
+    of cornerplotPCA are fastest serially, without the process start-up.
+
+    Parameters
+    ----------
+    coeffs : np.array
+        (nspec, ncomp) PCA coefficients, e.g. SNePCA.pcaCoeffMatrix.
+    truth : np.array
+        type code of every spectrum, e.g. SNePCA.pcaTypeCodes.
+    subspaces : list
+        list of tuples of column indices (0 based) into coeffs.
+    splits : list
+        see cvSplits.
+    splitInd : list
+        indices of the splits to score. All splits if None.
+    nproc : int
+        number of worker processes, at most one per fit. All cores if None,
+        no pool if 1. The number of workers of pool if pool is given.
+    pool : multiprocessing.Pool
+        pool created by scorePool with the same coeffs, truth and splits,
+        used instead of creating and closing a pool in this call.
+    chunksize : int
+        number of fits sent to a worker at once.
+
+    Returns
+    -------
+    scores : np.array
+        (nsubspace, nsplit) test scores, nsplit = len(splitInd).
+
+    """
+    if splitInd is None:
+        splitInd = range(len(splits))
+    tasks = [(tuple(cols), k) for cols in subspaces for k in splitInd]
+    if len(tasks) == 0:
+        return np.zeros((len(subspaces), len(splitInd)))
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    if pool is None:
+        nproc = max(1, min(nproc, len(tasks)))
+    if chunksize is None:
+        chunksize = max(1, int(np.ceil(len(tasks)/(4.0*nproc))))
+    if pool is not None:
+        scores = pool.map(scoreFold, tasks, chunksize)
+    elif nproc == 1:
+        initWorker(coeffs, truth, splits)
+        try:
+            scores = list(map(scoreFold, tasks))
+        finally:
+            _workerData.clear()
+    else:
+        pool = scorePool(coeffs, truth, splits, nproc)
+        try:
+            scores = pool.map(scoreFold, tasks, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    return np.array(scores).reshape(len(subspaces), len(splitInd))
+
+def svmPairScores(coeffs, truth, ncomp, ncv, nproc=1, seed=0):
+    """
+    Cross validated linear SVM scores of all 2D marginalizations of the
+    first ncomp PCA components, as plotted by SNePCA.cornerplotPCA.
+
+    Parameters
+    ----------
+    coeffs : np.array
+        (nspec, ncomp) PCA coefficients, e.g. SNePCA.pcaCoeffMatrix.
+    truth : np.array
+        type code of every spectrum, e.g. SNePCA.pcaTypeCodes.
+    ncomp : int
+        number of PCA components.
+    ncv : int
+        number of cross validation runs.
+    nproc : int
+        number of worker processes, see scoreSubspaces.
+    seed : int
+        see cvSplits.
+
+    Returns
+    -------
+    means_table : np.array
+        (ncomp, ncomp) symmetric table of the average svm scores.
+    std_table : np.array
+        (ncomp, ncomp) symmetric table of the svm score standard deviations.
+
+    """
+    splits = cvSplits(len(truth), ncv, seed=seed)
+    pairs = [(j, i) for i in range(ncomp) for j in range(ncomp) if i > j]
+    scores = scoreSubspaces(coeffs, truth, pairs, splits, nproc=nproc)
+    means_table = np.zeros((ncomp, ncomp))
+    std_table = np.zeros((ncomp, ncomp))
+    for (j, i), pairScores in zip(pairs, scores):
+        means_table[i,j] = means_table[j,i] = np.mean(pairScores)
+        std_table[i,j] = std_table[j,i] = np.std(pairScores)
+    return means_table, std_table
+
+def searchKey(coeffs, truth, ncv, test_size, seed):
+    """
+    Returns a hash identifying the data and cross validation settings of a
+    subspace search, stored in its checkpoint file.
+    """
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(coeffs, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(truth, dtype=np.int64).tobytes())
+    h.update(json.dumps([ncv, test_size, seed]).encode('utf-8'))
+    return h.hexdigest()
+
+def subspaceSearch(coeffs, truth, maxk, ncomp=None, ncv=50, nfirst=5, z=2.0, test_size=0.3,\
+                   seed=0, nproc=None, batchsize=None, checkpoint=None, verbose=True):
+    """
+    Scores every subset of k of the first ncomp PCA components, for
+    k = 2..maxk, with cross validated linear SVMs, and returns the subsets
+    ordered by average score. All subsets are scored on the same seeded
+    splits (see cvSplits), so their scores are directly comparable.
+
+    Subsets are pruned by racing: every subset of size k is first scored on
+    the first nfirst splits only. Its upper bound, the mean plus z standard
+    errors of those scores, is then compared with the best average score of
+    a fully scored subset of the same size. The subsets whose bound is lower
+    are not scored further. The others are scored on the remaining splits
+    in batches, in order of their first scores, so that the best score and
+    the pruning improve as the search goes. The bound is statistical, so a
+    larger z prunes less; z=np.inf scores every subset on every split.
+
+    The fits of every stage run in parallel on one pool of nproc worker
+    processes, created for the whole search, that receives coeffs, truth
+    and the splits once. If checkpoint is a file path, all scores are written to it after every
+    batch, and a search restarted with the same data and settings resumes
+    from it without refitting.
+
+    Parameters
+    ----------
+    coeffs : np.array
+        (nspec, ncomp) PCA coefficients, e.g. SNePCA.pcaCoeffMatrix.
+    truth : np.array
+        type code of every spectrum, e.g. SNePCA.pcaTypeCodes.
+    maxk : int
+        largest subset size.
+    ncomp : int
+        number of leading PCA components to choose from. All if None.
+    ncv : int
+        number of cross validation runs.
+    nfirst : int
+        number of splits every subset is scored on before pruning.
+    z : float
+        width of the pruning bound in standard errors.
+    test_size : float
+        see cvSplits.
+    seed : int
+        see cvSplits.
+    nproc : int
+        number of worker processes, at most one per subset. All cores if
+        None, no pool if 1.
+    batchsize : int
+        number of subsets scored on the remaining splits at once.
+    checkpoint : string
+        path of the JSON checkpoint file.
+    verbose : Boolean
+        Prints the progress of every subset size if True.
+
+    Returns
+    -------
+    results : list
+        one dict per subset with keys 'pcs' (tuple of 1 based component
+        numbers), 'k', 'mean', 'std', 'nfolds' (number of splits scored) and
+        'pruned'. The subsets scored on all splits come first, ordered by
+        decreasing mean score, followed by the pruned subsets, whose means
+        over the first nfirst splits are ordered the same way.
+
+    """
+    coeffs = np.asarray(coeffs)
+    truth = np.asarray(truth)
+    if ncomp is None:
+        ncomp = coeffs.shape[1]
+    coeffs = coeffs[:,:ncomp]
+    nfirst = min(nfirst, ncv)
+    nsubsets = sum(len(list(itertools.combinations(range(ncomp), k))) for k in range(2, maxk + 1))
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    nproc = max(1, min(nproc, nsubsets))
+    if batchsize is None:
+        batchsize = max(8, 4*nproc)
+    splits = cvSplits(len(truth), ncv, test_size=test_size, seed=seed)
+    key = searchKey(coeffs, truth, ncv, test_size, seed)
+
+    # scores[subset] holds the score on every split, NaN if not scored
+    scores = dict()
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            saved = json.load(f)
+        if saved['key'] != key:
+            raise ValueError("checkpoint %s was written for other data or settings"%(checkpoint))
+        for name, subsetScores in saved['scores'].items():
+            scores[tuple(int(col) for col in name.split(','))] = np.array(subsetScores, dtype=float)
+
+    def save():
+        if checkpoint is None:
+            return
+        data = dict(key=key, scores={','.join(str(col) for col in subset):\
+                                     [None if np.isnan(sc) else sc for sc in subsetScores]\
+                                     for subset, subsetScores in scores.items()})
+        tmppath = checkpoint + '.%i.tmp'%(os.getpid())
+        with open(tmppath, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmppath, checkpoint)
+        return
+
+    def score(subsets, splitInd):
+        # scores the subsets on the splits that are still missing
+        todo = [subset for subset in subsets if np.any(np.isnan(scores[subset][splitInd]))]
+        if len(todo) == 0:
+            return
+        newScores = scoreSubspaces(coeffs, truth, todo, splits, splitInd=splitInd, nproc=nproc, pool=pool)
+        for subset, subsetScores in zip(todo, newScores):
+            scores[subset][splitInd] = subsetScores
+        save()
+        return
+
+    pruned = set()
+    firstInd = np.arange(nfirst)
+    restInd = np.arange(nfirst, ncv)
+    pool = scorePool(coeffs, truth, splits, nproc) if nproc > 1 else None
+    try:
+        for k in range(2, maxk + 1):
+            subsets = list(itertools.combinations(range(ncomp), k))
+            for subset in subsets:
+                if subset not in scores:
+                    scores[subset] = np.full(ncv, np.nan)
+            score(subsets, firstInd)
+
+            firstMean = np.array([np.mean(scores[subset][firstInd]) for subset in subsets])
+            firstErr = np.array([np.std(scores[subset][firstInd])/np.sqrt(nfirst) for subset in subsets])
+            order = np.argsort(-firstMean, kind='stable')
+            best = -np.inf
+            nscored = 0
+            for start in range(0, len(order), batchsize):
+                batch = [i for i in order[start:start + batchsize] if firstMean[i] + z*firstErr[i] >= best]
+                pruned.update(subsets[i] for i in order[start:start + batchsize] if firstMean[i] + z*firstErr[i] < best)
+                if len(batch) == 0:
+                    continue
+                score([subsets[i] for i in batch], restInd)
+                nscored = nscored + len(batch)
+                best = max(best, max(np.mean(scores[subsets[i]]) for i in batch))
+            if verbose:
+                print('k=%i: %i subsets, %i scored on all %i splits, %i pruned, best %.3f'\
+                      %(k, len(subsets), nscored, ncv, len(subsets) - nscored, best))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    results = []
+    for subset, subsetScores in scores.items():
+        if len(subset) > maxk:
+            continue
+        scored = subsetScores[np.logical_not(np.isnan(subsetScores))]
+        results.append(dict(pcs=tuple(col + 1 for col in subset), k=len(subset), mean=float(np.mean(scored)),\
+                            std=float(np.std(scored)), nfolds=len(scored),\
+                            pruned=subset in pruned and len(scored) < ncv))
+    results.sort(key=lambda result: (result['pruned'], -result['mean'], result['k'], result['pcs']))
+    return results
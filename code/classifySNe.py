@@ -0,0 +1,374 @@
+import SNIDdataset as snidset
+import SNePCA
+from SNIDpipeline import SNIDpipeline
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+import multiprocessing
+import argparse
+import glob
+import os
+import time
+
+
+# Batch classification of SNID templates with the phase binned PCA + SVM
+# models of Williamson et al. (2019), following Classify_New_SN_Tutorial.ipynb.
+# Usage: python classifySNe.py 'path/to/*.lnw' -o classified.csv
+
+# (dataset file, phasemin, phasemax, SVM eigenspectrum pair, signs of the
+# first 5 eigenspectra). The signs are the ones chosen in the tutorial and
+# the figure scripts.
+PHASE_MODELS = [
+    ('dataset0.npz', -5, 5, (1, 5), [1, 1, -1, -1, -1]),
+    ('dataset5.npz', 0, 10, (1, 3), [1, -1, -1, -1, 1]),
+    ('dataset10.npz', 5, 15, (1, 3), [-1, -1, 1, -1, 1]),
+    ('dataset15.npz', 10, 20, (1, 3), [1, -1, -1, 1, 1]),
+]
+
+# maximum wavelength mismatch (angstroms) between a template and a model grid
+WVLTOL = 0.05
+
+
+def trainModels(datadir):
+    """
+    Fits the PCA of every phase bin in PHASE_MODELS, applies the eigenspectrum
+    signs, and trains a linear SVM on the SVM eigenspectrum pair.
+
+    Parameters
+    ----------
+    datadir : string
+        directory with the preprocessed datasets, e.g. Data/DataProducts.
+
+    Returns
+    -------
+    models : list
+        list of SNePCA objects, one per phase bin.
+
+    """
+    models = []
+    for filename, phasemin, phasemax, pcs, signs in PHASE_MODELS:
+        dataset = snidset.load(os.path.join(datadir, filename))
+        model = SNePCA.SNePCA(dataset, phasemin, phasemax)
+        model.snidPCA()
+        model.calcPCACoeffs()
+        model.flipSigns(signs)
+        model.calcTypeStatistics()
+        model.trainSVM(pcs)
+        models.append(model)
+    return models
+
+def saveModels(modeldir, models, ncomp=None):
+    """
+    Saves the phase models with SNePCA.saveModel as modeldir/model<i>.npz.
+    """
+    if not os.path.isdir(modeldir):
+        os.makedirs(modeldir)
+    for i, model in enumerate(models):
+        model.saveModel(os.path.join(modeldir, 'model%i.npz'%(i)), ncomp=ncomp)
+    return
+
+def loadModels(modeldir):
+    """
+    Loads the phase models saved by saveModels.
+
+    Parameters
+    ----------
+    modeldir : string
+
+    Returns
+    -------
+    models : list
+        list of SNePCA objects, one per phase bin.
+
+    """
+    paths = sorted(glob.glob(os.path.join(modeldir, 'model*.npz')), key=lambda path: int(os.path.basename(path)[5:-4]))
+    assert len(paths) > 0, "no model files in %s"%(modeldir)
+    return [SNePCA.SNePCA.loadModel(path) for path in paths]
+
+def preprocessTemplate(args):
+    """
+    Loads and preprocesses one SNID template as in the classification
+    tutorial: NaN gaps, gap interpolation, wavelength cut and smoothing of
+    every spectrum in the phase range of the models. Used by the worker
+    processes of classifyTemplates.
+
+    Parameters
+    ----------
+    args : tuple
+        (lnwfile, minwvl, maxwvl, maxgapsize, velcut, phaseRangeList)
+
+    Returns
+    -------
+    result : dict
+        file, SN name, wavelengths, phases, phase keys, (nphase, nwvl) flux,
+        stage timings, and the error message if the template failed.
+
+    """
+    lnwfile, minwvl, maxwvl, maxgapsize, velcut, phaseRangeList = args
+    result = dict(file=lnwfile, error=None, t_load=0.0, t_preprocess=0.0, t_smooth=0.0)
+    t0 = time.time()
+    snobj, error = snidset.loadTemplate(lnwfile)
+    t1 = time.time()
+    result['t_load'] = t1 - t0
+    if error is not None:
+        result['error'] = error
+        return result
+    # errors of the later stages are reported like load errors, so that one
+    # bad template does not abort the whole pool.map.
+    try:
+        snobj.toColumnar()
+        pipeline = SNIDpipeline().snidsetNAN().interpGaps(minwvl, maxwvl, maxgapsize)\
+                   .datasetWavelengthRange(minwvl, maxwvl).filterPhases(phaseRangeList, False)
+        snobj = pipeline.apply(snobj)
+    except Exception as e:
+        result['t_preprocess'] = time.time() - t1
+        result['error'] = 'preprocessing failed: %s: %s'%(type(e).__name__, e)
+        return result
+    t2 = time.time()
+    result['t_preprocess'] = t2 - t1
+    if snobj is None:
+        result['error'] = 'no spectra in the model phase ranges without large gaps'
+        return result
+    try:
+        for phasekey in snobj.getSNCols():
+            snobj.smoothSpectrum(phasekey, velcut)
+    except Exception as e:
+        result['t_smooth'] = time.time() - t2
+        result['error'] = 'smoothing failed: %s: %s'%(type(e).__name__, e)
+        return result
+    result['t_smooth'] = time.time() - t2
+    result['sn'] = snobj.header['SN']
+    result['wavelengths'] = snobj.wavelengths
+    result['phases'] = np.asarray(snobj.phases)
+    result['phasekeys'] = list(snobj.getSNCols())
+    result['flux'] = np.array(snobj.specMatrix().T)
+    return result
+
+def chooseModels(phases, models, uniquePhaseFlag):
+    """
+    Returns the index of the phase appropriate model of every spectrum: the
+    model whose phase range contains the phase and whose center is closest.
+    If uniquePhaseFlag is True, only the spectrum closest to the model center
+    is kept for each model, as SNIDdataset.filterPhases does.
+
+    Parameters
+    ----------
+    phases : np.array
+    models : list
+    uniquePhaseFlag : Boolean
+
+    Returns
+    -------
+    modelInd : np.array
+        model index of every spectrum, -1 if no model applies.
+
+    """
+    phases = np.asarray(phases, dtype=float)
+    lo = np.array([model.phasemin for model in models])
+    hi = np.array([model.phasemax for model in models])
+    centers = 0.5*(lo + hi)
+    dist = np.abs(phases[:,np.newaxis] - centers[np.newaxis,:])
+    inRange = np.logical_and(phases[:,np.newaxis] >= lo, phases[:,np.newaxis] <= hi)
+    dist[np.logical_not(inRange)] = np.inf
+    modelInd = np.argmin(dist, axis=1)
+    modelInd[np.all(np.logical_not(inRange), axis=1)] = -1
+    if uniquePhaseFlag:
+        for m in np.unique(modelInd[modelInd >= 0]):
+            rows = np.where(modelInd == m)[0]
+            closest = rows[np.argmin(dist[rows, m])]
+            modelInd[rows[rows != closest]] = -1
+    return modelInd
+
+def classifyTemplates(lnwfiles, models, ncomp=5, minwvl=4000, maxwvl=7000, maxgapsize=20,\
+                      velcut=3000, uniquePhaseFlag=False, nproc=None, verbose=True):
+    """
+    Preprocesses SNID templates across a pool of nproc worker processes,
+    projects every spectrum onto the eigenspectra of its phase appropriate
+    model with one SNePCA.transform call per model and wavelength grid, and
+    predicts its type with the model's SVM.
+
+    Parameters
+    ----------
+    lnwfiles : list
+        paths of the SNID templates.
+    models : list
+        SNePCA phase models, see trainModels and loadModels.
+    ncomp : int
+        number of PCA coefficients to report.
+    minwvl : float
+    maxwvl : float
+    maxgapsize : float
+        see SNIDdataset.interpGaps
+    velcut : float
+        smoothing velocity cut, see SNIDsn.smoothSpectrum. The training
+        datasets were smoothed with a velcut that depends on the SN type
+        (1000 km/s or 3000 km/s, see the recommendation in SNIDsn.smooth).
+        The type of a new spectrum is not known before it is classified, so
+        every spectrum is smoothed with this one velcut, as in the
+        classification tutorial, and the smoothing of some candidates does
+        not match the training spectra of their type.
+    uniquePhaseFlag : Boolean
+        classify only the spectrum closest to the center of each model if True.
+    nproc : int
+        number of worker processes.
+    verbose : Boolean
+        Prints the total time of every stage if True.
+
+    Returns
+    -------
+    table : pandas.DataFrame
+        one row per classified spectrum.
+    failed : list
+        list of (file, error) tuples.
+
+    """
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    nproc = max(1, min(nproc, len(lnwfiles)))
+    phaseRangeList = [(model.phasemin, model.phasemax) for model in models]
+    args = [(lnwfile, minwvl, maxwvl, maxgapsize, velcut, phaseRangeList) for lnwfile in lnwfiles]
+    t0 = time.time()
+    if nproc == 1:
+        results = list(map(preprocessTemplate, args))
+    else:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            results = pool.map(preprocessTemplate, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    tpool = time.time() - t0
+
+    rows = []
+    failed = []
+    for result in results:
+        if result['error'] is not None:
+            failed.append((result['file'], result['error']))
+            continue
+        modelInd = chooseModels(result['phases'], models, uniquePhaseFlag)
+        gridMismatch = False
+        for i in np.where(modelInd >= 0)[0]:
+            model = models[modelInd[i]]
+            modelWvl = model.wavelengths
+            if len(result['wavelengths']) != len(modelWvl) or \
+               np.max(np.abs(result['wavelengths'] - modelWvl)) > WVLTOL:
+                gridMismatch = True
+                continue
+            rows.append(OrderedDict([('file', result['file']), ('sn', result['sn']),\
+                                     ('phasekey', result['phasekeys'][i]), ('phase', result['phases'][i]),\
+                                     ('model', 0.5*(model.phasemin + model.phasemax)), ('modelInd', modelInd[i]),\
+                                     ('t_load', result['t_load']), ('t_preprocess', result['t_preprocess']),\
+                                     ('t_smooth', result['t_smooth']), ('flux', result['flux'][i]),\
+                                     ('wavelengths', result['wavelengths'])]))
+        if gridMismatch:
+            failed.append((result['file'], 'wavelength grid does not match the model grid'))
+
+    table = pd.DataFrame(rows, columns=['file', 'sn', 'phasekey', 'phase', 'model', 'modelInd',\
+                                        't_load', 't_preprocess', 't_smooth', 'flux', 'wavelengths'])
+    coeffs = np.full((len(table), ncomp), np.nan)
+    predicted = np.empty(len(table), dtype=object)
+    tproject = np.zeros(len(table))
+    for m, model in enumerate(models):
+        rowInd = np.where(table['modelInd'].values == m)[0]
+        if len(rowInd) == 0:
+            continue
+        t1 = time.time()
+        # one transform per distinct wavelength grid, see SNIDdataset.wavelengthGroups
+        grids = OrderedDict()
+        for i in rowInd:
+            grids.setdefault(table['wavelengths'].values[i].tobytes(), []).append(i)
+        for ids in grids.values():
+            ids = np.array(ids)
+            X = np.vstack(table['flux'].values[ids])
+            c, ids = model.transform(X, wavelengths=table['wavelengths'].values[ids[0]], ids=ids,\
+                                     ncomp=max(ncomp, max(model.svmPCs)), wvltol=WVLTOL)
+            coeffs[ids] = c[:,:ncomp]
+            predicted[ids] = model.predictTypes(c)
+        tproject[rowInd] = (time.time() - t1)/len(rowInd)
+
+    for j in range(ncomp):
+        table['PC%i'%(j + 1)] = coeffs[:,j]
+    table['type'] = predicted
+    table['t_classify'] = tproject
+    table = table.drop(columns=['modelInd', 'flux', 'wavelengths'])
+
+    if verbose:
+        ntemplates = len(lnwfiles)
+        print('preprocessed %i templates in %.2f s with %i worker(s), %i failed'%(ntemplates, tpool, nproc, len(failed)))
+        for stage in ['t_load', 't_preprocess', 't_smooth']:
+            print('  %-13s %.3f s total'%(stage[2:], sum(result[stage] for result in results)))
+        print('  %-13s %.3f s total for %i spectra'%('classify', tproject.sum(), len(table)))
+        for filename, error in failed:
+            print('failed: %s (%s)'%(filename, error))
+    return table, failed
+
+def expandInputs(inputs):
+    """
+    Expands directories and glob patterns into a sorted list of .lnw files.
+
+    Parameters
+    ----------
+    inputs : list
+        files, directories or glob patterns.
+
+    Returns
+    -------
+    lnwfiles : list
+
+    """
+    lnwfiles = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.lnw')
+        lnwfiles.extend(sorted(glob.glob(pattern)))
+    return list(OrderedDict.fromkeys(lnwfiles))
+
+def writeTable(table, path):
+    """
+    Writes the classification table as parquet if path ends with .parquet,
+    otherwise as CSV.
+    """
+    if path.endswith('.parquet'):
+        table.to_parquet(path, index=False)
+    else:
+        table.to_csv(path, index=False)
+    return
+
+def main():
+    parser = argparse.ArgumentParser(description='Classify SNID templates with the PCA + SVM models of Williamson et al. (2019).')
+    parser.add_argument('inputs', nargs='+', help='.lnw files, directories or glob patterns')
+    parser.add_argument('-o', '--output', default='classified.csv', help='output table (.csv or .parquet)')
+    parser.add_argument('--datadir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data', 'DataProducts'),\
+                        help='directory with the preprocessed datasets the models are trained on')
+    parser.add_argument('--models', default=None, help='directory with saved phase models; the models are trained from --datadir if not given')
+    parser.add_argument('--save-models', default=None, help='save the trained phase models to this directory')
+    parser.add_argument('--ncomp', type=int, default=5, help='number of PCA coefficients to report')
+    parser.add_argument('--velcut', type=float, default=3000,\
+                        help='smoothing velocity cut (km/s) applied to every spectrum. The training datasets were '\
+                             'smoothed with a type dependent velcut (1000 or 3000 km/s, see SNIDsn.smooth), so one '\
+                             'velcut does not match the training preprocessing of every type')
+    parser.add_argument('--unique', action='store_true', help='classify only the spectrum closest to each model phase')
+    parser.add_argument('--nproc', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    lnwfiles = expandInputs(args.inputs)
+    if len(lnwfiles) == 0:
+        parser.error('no .lnw files found')
+    t0 = time.time()
+    if args.models is not None:
+        models = loadModels(args.models)
+        print('loaded %i phase models in %.3f s'%(len(models), time.time() - t0))
+    else:
+        models = trainModels(args.datadir)
+        print('trained %i phase models in %.2f s'%(len(models), time.time() - t0))
+    if args.save_models is not None:
+        saveModels(args.save_models, models)
+    table, failed = classifyTemplates(lnwfiles, models, ncomp=args.ncomp, velcut=args.velcut,\
+                                      uniquePhaseFlag=args.unique, nproc=args.nproc)
+    writeTable(table, args.output)
+    print('wrote %i classified spectra to %s'%(len(table), args.output))
+    return
+
+
+if __name__ == '__main__':
+    main()